@@ -0,0 +1,209 @@
+"""
+End-to-end benchmark of the seat comfort system on recorded frames, without PiCamera nor the link to the Raspberry.
+A SeatComfortServer is started on the loopback interface and the recorded frames are replayed, for every message
+type, frame size and number of concurrent clients (seats):
+    - in-process: the requests are handled directly by the server (inference only)
+    - loopback:   the requests go through the wire protocol on a local connection (encoding, network, decoding)
+The frames pass through the client-side change detection (FrameGate) as in the detectors (all but the need
+detection), unless --no-gate is given. It reports throughput, latency percentiles, CPU time per request and peak
+memory of the process (client and server together).
+
+The server works on a temporary copy of its data (profiles, face index and pictures of the users) without the
+incremental enrollment, so the runs never change the data of the system and are comparable.
+
+Usage (from the root of the project, the server runs in the server directory):
+    python -m benchmarks.end_to_end --frames server/data/user_faces_db --clients 1 4 --sizes 432x540 216x270
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+import metrics
+import socket_communication
+from benchmarks.load_test import MESSAGE_TYPES, load_frames
+from client.frame_gate import FrameGate
+from server.result_cache import ResultCache
+from server.seat_comfort_server import ClientSession, SeatComfortServer
+
+
+def load_recording(path, max_frames=300):
+    """
+    Loads the recorded frames: a video (read with the VideoFileSource of the client), a .npy file or a directory
+    of images
+    """
+    if os.path.splitext(path)[1].lower() not in (".mp4", ".avi", ".mkv", ".h264"):
+        return load_frames(path)
+    from client.camera_source import RESOLUTION, VideoFileSource
+
+    source = VideoFileSource(path, realtime=False)
+    source.open()
+    frames = []
+    try:
+        for _ in range(max_frames):
+            frame = np.empty((RESOLUTION[1], RESOLUTION[0], 3), dtype=np.uint8)
+            source.capture_into(frame)
+            frames.append(frame)
+    finally:
+        source.close()
+    return frames
+
+
+def resize_frames(frames, size):  # size: (width, height)
+    return [np.array(Image.fromarray(frame).resize(size)) for frame in frames]
+
+
+def usage():  # CPU seconds (user + system) and peak resident memory (bytes) of the process
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024
+
+
+def replay(frames, msg_type, num_requests, send, use_gate):
+    """
+    Replays the frames as the detectors do: a frame is sent only if the FrameGate detects a change.
+    Returns the latencies of the requests sent and the number of frames skipped
+    """
+    gate = FrameGate(socket_communication.PHASES[msg_type])
+    latencies = []
+    for i in range(num_requests):
+        frame = frames[i % len(frames)]
+        if use_gate:
+            thumbnail = gate.thumbnail(frame)
+            if gate.skip(thumbnail):
+                continue
+        start_time = time.perf_counter()
+        result = send({"type": msg_type, "frame": frame, "frame_id": i + 1})
+        latencies.append(time.perf_counter() - start_time)
+        if use_gate:
+            gate.update(thumbnail, result)
+    return latencies, gate.skipped
+
+
+# Every simulated client is a new seat, in both modes: the recognition cascades start empty for every configuration
+_seat_ids = itertools.count()
+
+
+def in_process_client(server, address):
+    session = ClientSession(address, server.seat_recognition(f"benchmark-{next(_seat_ids)}"))
+    return lambda data: server._process(data, session)[0]
+
+
+def loopback_client(address, codec):
+    connection = socket_communication.Connection(socket.create_connection(address), "client")
+    connection.negotiate_codec([codec], seat=f"benchmark-{next(_seat_ids)}")
+    connection.start_dispatcher()
+    phases = socket_communication.PHASES
+    return (lambda data: connection.request(data, phases[data["type"]]).result()), connection
+
+
+def run_config(server, address, mode, frames, msg_type, num_clients, num_requests, codec, use_gate):
+    latencies = []
+    skipped = []
+    connections = []
+    senders = []
+    for i in range(num_clients):
+        if mode == "in-process":
+            senders.append(in_process_client(server, ("in-process", i)))
+        else:
+            send, connection = loopback_client(address, codec)
+            senders.append(send)
+            connections.append(connection)
+
+    def client(send):
+        client_latencies, client_skipped = replay(frames, msg_type, num_requests, send, use_gate)
+        latencies.extend(client_latencies)
+        skipped.append(client_skipped)
+
+    threads = [threading.Thread(target=client, args=(send,)) for send in senders]
+    cpu_time, _ = usage()
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    cpu_time = usage()[0] - cpu_time
+    for connection in connections:
+        connection.close()
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99]) if latencies else (0, 0, 0)
+    return {"mode": mode, "type": msg_type, "size": f"{frames[0].shape[1]}x{frames[0].shape[0]}",
+            "clients": num_clients, "requests": len(latencies), "skipped": sum(skipped),
+            "throughput": len(latencies) / elapsed, "p50": p50, "p90": p90, "p99": p99,
+            "cpu_per_request": cpu_time / len(latencies) * 1000 if latencies else 0,
+            "cpu_utilization": cpu_time / elapsed, "peak_memory": usage()[1] / 2 ** 20}
+
+
+def print_header():
+    print(f"{'mode':<12}{'type':<18}{'size':>9}{'clients':>8}{'reqs':>6}{'skip':>6}{'req/s':>9}{'p50 ms':>9}"
+          f"{'p90 ms':>9}{'p99 ms':>9}{'cpu ms/req':>11}{'cpu %':>7}{'peak MB':>9}")
+
+
+def print_result(result):
+    print(f"{result['mode']:<12}{result['type']:<18}{result['size']:>9}{result['clients']:>8}{result['requests']:>6}"
+          f"{result['skipped']:>6}{result['throughput']:>9.2f}{result['p50']:>9.1f}{result['p90']:>9.1f}"
+          f"{result['p99']:>9.1f}{result['cpu_per_request']:>11.1f}{result['cpu_utilization'] * 100:>7.0f}"
+          f"{result['peak_memory']:>9.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end benchmark on recorded frames")
+    parser.add_argument("--frames", default="server/data/user_faces_db",
+                        help="video, directory of images or .npy file with the recorded frames")
+    parser.add_argument("--modes", nargs="+", default=["in-process", "loopback"], choices=["in-process", "loopback"])
+    parser.add_argument("--types", nargs="+", default=MESSAGE_TYPES, choices=MESSAGE_TYPES)
+    parser.add_argument("--sizes", nargs="+", default=["432x540"], help="frame sizes (width x height)")
+    parser.add_argument("--clients", nargs="+", type=int, default=[1, 4], help="numbers of concurrent clients")
+    parser.add_argument("--requests", type=int, default=30, help="frames replayed by each client")
+    parser.add_argument("--codec", default="jpeg", help="frame codec of the loopback connections")
+    parser.add_argument("--workers", type=int, default=4, help="size of the inference worker pool of the server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--no-gate", action="store_true", help="send every frame (no client change detection)")
+    parser.add_argument("--no-cache", action="store_true", help="disable the result cache of the server")
+    parser.add_argument("--output", help="JSON file where the results are saved (to compare runs)")
+    args = parser.parse_args()
+
+    recording = load_recording(args.frames)
+    output = os.path.abspath(args.output) if args.output else None
+    os.chdir("server")  # the server uses paths relative to its directory
+    data_dir = tempfile.mkdtemp(prefix="seat-comfort-benchmark-")
+    for name in ("user_faces_db", "face_index", "users"):
+        if os.path.isdir(os.path.join("data", name)):
+            shutil.copytree(os.path.join("data", name), os.path.join(data_dir, name))
+        else:
+            os.makedirs(os.path.join(data_dir, name))
+    for name in ("users.db", "users.db-wal"):
+        if os.path.isfile(os.path.join("data", name)):
+            shutil.copy(os.path.join("data", name), data_dir)
+    server = SeatComfortServer("127.0.0.1", args.port, args.workers, data_dir=data_dir, incremental_enrollment=False)
+    if args.no_cache:
+        server._results = ResultCache({})
+    threading.Thread(target=server.run, daemon=True).start()
+    server._models.wait_ready()
+    print("models:", server._models.report())
+
+    results = []
+    print_header()
+    for size in args.sizes:
+        frames = resize_frames(recording, tuple(int(value) for value in size.split("x")))
+        for mode in args.modes:
+            for msg_type in args.types:
+                for num_clients in args.clients:
+                    result = run_config(server, ("127.0.0.1", args.port), mode, frames, msg_type, num_clients,
+                                        args.requests, args.codec,
+                                        not args.no_gate and msg_type != "need-detection")
+                    print_result(result)
+                    results.append(result)
+    print(metrics.report())
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    shutil.rmtree(data_dir, ignore_errors=True)
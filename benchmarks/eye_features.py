@@ -0,0 +1,52 @@
+"""
+Micro-benchmark of the eye feature extraction: per frame time of the face detection and of the extraction of
+the features of both the eyes (landmarks, crops, key points, distances and angles).
+
+Usage (from the root of the project):
+    python -m benchmarks.eye_features --frames server/data/user_faces_db --repeat 20
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.load_test import load_frames
+from server.eyesdetection.eyes_detection import EyesDetection
+
+
+def print_result(name, times):
+    p50, p99 = np.percentile(np.array(times) * 1000, [50, 99])
+    print(f"{name:<20}{np.mean(times) * 1000:>10.2f}{p50:>10.2f}{p99:>10.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the eye feature extraction")
+    parser.add_argument("--frames", default="server/data/user_faces_db",
+                        help="directory of images or .npy file with the recorded frames")
+    parser.add_argument("--repeat", type=int, default=10, help="times each frame is processed")
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames) * args.repeat
+    eyes_detection = EyesDetection()
+    detection_times = []
+    features_times = []
+    for frame in frames:
+        start_time = time.perf_counter()
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        faces = eyes_detection.detector(gray)
+        detection_times.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        for face in faces:
+            face_img = gray[max(0, face.top()):min(gray.shape[0], face.bottom()),
+                            max(0, face.left()):min(gray.shape[1], face.right())]
+            eyes_detection.get_eyes_attributes(cv2.resize(face_img, (100, 100)), eyes_detection.predictor,
+                                               (24, 24, 1))
+        features_times.append(time.perf_counter() - start_time)
+
+    print(f"{len(frames)} frames")
+    print(f"{'stage':<20}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    print_result("face detection", detection_times)
+    print_result("eye features", features_times)
+    print_result("total", np.add(detection_times, features_times))
@@ -0,0 +1,78 @@
+"""
+Benchmark of the eye state inference: one predict call per eye (as before the batching), one predict call
+per frame and micro-batching of the frames of several concurrent connections.
+
+Usage (from the root of the project):
+    python -m benchmarks.eyes_batching --frames server/data/user_faces_db --repeat 20 --threads 4
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.load_test import load_frames
+from server.eyes_batcher import EyesBatchScheduler
+from server.eyesdetection.eyes_detection import EyesDetection
+
+
+def classify_per_eye(eyes_detection, frame):  # Inference as before the batching: one predict for each eye
+    inputs = eyes_detection.get_eyes_inputs(frame)
+    if inputs is None:
+        return -1
+    predictions = [eyes_detection.predict_eyes([x[i:i + 1] for x in inputs])[0] for i in range(2)]
+    return eyes_detection.get_eyes_state(predictions)
+
+
+def run_sequential(classify, frames):
+    latencies = []
+    for frame in frames:
+        start_time = time.perf_counter()
+        classify(frame)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def run_concurrent(classify, frames, num_threads):
+    latencies = []
+
+    def worker(worker_frames):
+        latencies.extend(run_sequential(classify, worker_frames))
+
+    threads = [threading.Thread(target=worker, args=(frames[i::num_threads],)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def print_result(name, latencies, elapsed):
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    print(f"{name:<28}{len(latencies) / elapsed:>10.2f}{np.mean(latencies) * 1000:>10.1f}{p50:>10.1f}{p99:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the batched eye state inference")
+    parser.add_argument("--frames", default="server/data/user_faces_db",
+                        help="directory of images or .npy file with the recorded frames")
+    parser.add_argument("--repeat", type=int, default=10, help="times each frame is classified")
+    parser.add_argument("--threads", type=int, default=4, help="concurrent connections for the micro-batching")
+    parser.add_argument("--window", type=float, default=0.01, help="micro-batching window in seconds")
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames) * args.repeat
+    eyes_detection = EyesDetection()
+    eyes_detection.warm_up(np.zeros_like(frames[0]))
+    batcher = EyesBatchScheduler(eyes_detection, window=args.window)
+
+    print(f"{'mode':<28}{'fps':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, run in [("predict per eye", lambda: run_sequential(lambda f: classify_per_eye(eyes_detection, f),
+                                                                 frames)),
+                      ("predict per frame", lambda: run_sequential(eyes_detection.classify_eyes, frames)),
+                      (f"micro-batch ({args.threads} threads)", lambda: run_concurrent(batcher.classify_eyes, frames,
+                                                                                      args.threads))]:
+        start = time.perf_counter()
+        result = run()
+        print_result(name, result, time.perf_counter() - start)
+    print("micro-batching:", batcher.report())
@@ -0,0 +1,98 @@
+"""
+Load test of the seat comfort server: N simulated clients (seats) connect to a running server and send the
+recorded frames with the given message types. It reports the throughput and the p50/p99 latency per message type.
+
+Usage (from the root of the project):
+    python -m benchmarks.load_test --host 127.0.0.1 --port 8000 --clients 8 --requests 50
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+import socket_communication
+
+FRAME_SIZE = (432, 540)  # (width, height) of the frames captured by the client
+MESSAGE_TYPES = ['user-recognition', 'need-detection', 'mood-detection', 'analyze']
+
+
+def load_frames(path):
+    """
+    Loads the recorded frames: a .npy file with an array of frames or a directory of images
+    (resized to the size of the frames captured by the client)
+    """
+    if path.endswith(".npy"):
+        return list(np.load(path))
+    frames = []
+    for file_name in sorted(os.listdir(path)):
+        if os.path.splitext(file_name)[1].lower() in (".jpg", ".jpeg", ".png"):
+            img = Image.open(os.path.join(path, file_name)).convert("RGB").resize(FRAME_SIZE)
+            frames.append(np.array(img))
+    if len(frames) == 0:
+        raise ValueError("No frames found in " + path)
+    return frames
+
+
+def simulated_client(seat, host, port, frames, message_types, num_requests, codec, latencies, errors):
+    sock = socket.create_connection((host, port))
+    connection = socket_communication.Connection(sock, "client")
+    try:
+        connection.negotiate_codec([codec], seat=seat)
+        for i in range(num_requests):
+            msg_type = message_types[i % len(message_types)]
+            frame = frames[i % len(frames)]
+            start_time = time.perf_counter()
+            connection.send({"type": msg_type, "frame": frame}, socket_communication.PHASES[msg_type])
+            connection.recv(socket_communication.PHASES[msg_type])
+            latencies[msg_type].append(time.perf_counter() - start_time)
+    except (ConnectionResetError, BrokenPipeError, socket_communication.ProtocolError) as e:
+        errors.append(e)
+    finally:
+        connection.close()
+
+
+def run_load_test(host, port, frames, num_clients, num_requests, message_types, codec):
+    latencies = {msg_type: [] for msg_type in message_types}
+    errors = []
+    clients = [threading.Thread(target=simulated_client,
+                                args=(f"load-test-{i}", host, port, frames, message_types, num_requests, codec,
+                                      latencies, errors))
+               for i in range(num_clients)]
+    start_time = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start_time
+    return latencies, errors, elapsed
+
+
+def print_report(latencies, errors, elapsed):
+    total = sum(len(values) for values in latencies.values())
+    print(f"{total} requests in {elapsed:.2f} s: {total / elapsed:.2f} req/s, {len(errors)} client errors")
+    print(f"{'type':<20}{'count':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for msg_type, values in latencies.items():
+        if len(values) == 0:
+            continue
+        p50, p99 = np.percentile(np.array(values) * 1000, [50, 99])
+        print(f"{msg_type:<20}{len(values):>8}{len(values) / elapsed:>10.2f}{p50:>10.1f}{p99:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test of the seat comfort server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--clients", type=int, default=4, help="number of simulated seats")
+    parser.add_argument("--requests", type=int, default=20, help="requests sent by each client")
+    parser.add_argument("--types", nargs="+", default=MESSAGE_TYPES, choices=MESSAGE_TYPES)
+    parser.add_argument("--codec", default="raw", help="frame codec proposed to the server")
+    parser.add_argument("--frames", default="server/data/user_faces_db",
+                        help="directory of images or .npy file with the recorded frames")
+    args = parser.parse_args()
+
+    print_report(*run_load_test(args.host, args.port, load_frames(args.frames), args.clients, args.requests,
+                                args.types, args.codec))
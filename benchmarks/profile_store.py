@@ -0,0 +1,79 @@
+"""
+Benchmark of the user profile store: save, lookup (from the database and from the cache) and batch lookup latency
+with many registered users, optionally compared with the previous storage (one joblib file per user).
+
+Usage (from the root of the project):
+    python -m benchmarks.profile_store --users 10000 --lookups 2000 --legacy
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from server.users_storage_controller import UsersStorageController
+from user import User
+
+
+def make_users(num_users):
+    return [User(f"user{i:06d}", random.randrange(-30, 30, 10), random.randrange(30, 90, 10))
+            for i in range(num_users)]
+
+
+def timed(function, items):  # latencies of function on every item
+    latencies = []
+    for item in items:
+        start_time = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def print_result(name, latencies):
+    p50, p99 = np.percentile(np.array(latencies) * 1e6, [50, 99])
+    print(f"{name:<32}{len(latencies):>8}{np.mean(latencies) * 1e6:>12.1f}{p50:>12.1f}{p99:>12.1f}")
+
+
+def run_store(directory, users, names, batch_size):
+    db_path = os.path.join(directory, "users.db")
+    store = UsersStorageController(db_path, legacy_path=None)
+    print_result("save (one transaction each)", timed(store.save_user, users))
+    store.close()
+    # a new store has an empty cache: the first lookups read the database
+    store = UsersStorageController(db_path, legacy_path=None, cache_size=len(users))
+    print_result("lookup (database)", timed(store.retrieve_user, names))
+    print_result("lookup (cache)", timed(store.retrieve_user, names))
+    store.close()
+    store = UsersStorageController(db_path, legacy_path=None)
+    batches = [names[i:i + batch_size] for i in range(0, len(names), batch_size)]
+    print_result(f"batch lookup of {batch_size} (database)", timed(store.retrieve_users, batches))
+    store.close()
+
+
+def run_legacy(directory, users, names):
+    import joblib
+
+    users_path = os.path.join(directory, "users")
+    os.makedirs(users_path)
+    print_result("legacy save (joblib)", timed(lambda user: joblib.dump(user, os.path.join(users_path,
+                                                                                         user.get_name())), users))
+    print_result("legacy lookup (joblib)", timed(lambda name: joblib.load(os.path.join(users_path, name)), names))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the user profile store")
+    parser.add_argument("--users", type=int, default=10000, help="number of registered users")
+    parser.add_argument("--lookups", type=int, default=2000, help="number of users looked up")
+    parser.add_argument("--batch", type=int, default=100, help="users loaded with a single call")
+    parser.add_argument("--legacy", action="store_true", help="also benchmark one joblib file per user")
+    args = parser.parse_args()
+
+    users = make_users(args.users)
+    names = random.sample([user.get_name() for user in users], min(args.lookups, args.users))
+    print(f"{'operation':<32}{'count':>8}{'mean us':>12}{'p50 us':>12}{'p99 us':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        run_store(directory, users, names, args.batch)
+        if args.legacy:
+            run_legacy(directory, users, names)
@@ -0,0 +1,155 @@
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+RESOLUTION = (432, 540)  # (width, height) of the frames
+
+
+class FrameSource:
+    """
+    Source of the frames captured by the ImagePicker. capture_into fills a preallocated (height, width, 3)
+    RGB array with the next frame, blocking until it is available, and returns its JPEG if the source
+    produces one (None otherwise)
+    """
+
+    def open(self):
+        pass
+
+    def capture_into(self, out):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class _RawOutput:
+    # Output for picamera: receives the raw frame, possibly in several writes, into a preallocated buffer
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._offset = 0
+
+    def write(self, data):
+        size = min(len(data), len(self._view) - self._offset)
+        self._view[self._offset:self._offset + size] = memoryview(data).cast('B')[:size]
+        self._offset += size
+        return len(data)
+
+    def flush(self):
+        self._offset = 0
+
+
+class PiCameraSource(FrameSource):
+    """
+    Frames of the PiCamera. With the video port (default) the camera streams raw RGB frames continuously,
+    with the still port every frame is a still JPEG capture (slower, but the JPEG can be sent to the server)
+    """
+
+    def __init__(self, resolution=RESOLUTION, framerate=30, use_video_port=True):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.use_video_port = use_video_port
+        self._camera = None
+        self._stream = None
+        self._raw = None
+
+    def open(self):
+        from picamera import PiCamera
+
+        self._camera = PiCamera()
+        time.sleep(2)
+        self._camera.hflip = True
+        self._camera.resolution = self.resolution
+        self._camera.framerate = self.framerate
+        if self.use_video_port:
+            # raw frames are padded by the camera to multiples of 32 (width) and 16 (height)
+            width, height = self.resolution
+            self._raw = np.empty(((height + 15) // 16 * 16, (width + 31) // 32 * 32, 3), dtype=np.uint8)
+            self._stream = self._camera.capture_continuous(_RawOutput(self._raw), format="rgb", use_video_port=True)
+
+    def capture_into(self, out):
+        if self.use_video_port:
+            next(self._stream)
+            np.copyto(out, self._raw[:out.shape[0], :out.shape[1]])
+            return None
+        img = io.BytesIO()
+        self._camera.capture(img, format="jpeg")
+        np.copyto(out, np.asarray(Image.open(img)))
+        return img.getvalue()
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+        if self._camera is not None:
+            self._camera.close()
+
+
+class VideoFileSource(FrameSource):
+    """
+    Frames of a video file (played in loop at its frame rate), to replace the camera without hardware
+    """
+
+    def __init__(self, path, realtime=True):
+        self.path = path
+        self.realtime = realtime
+        self._video = None
+        self._period = 0
+        self._next_time = 0
+
+    def open(self):
+        import cv2
+
+        self._video = cv2.VideoCapture(self.path)
+        if not self._video.isOpened():
+            raise IOError("Cannot open the video " + self.path)
+        fps = self._video.get(cv2.CAP_PROP_FPS)
+        self._period = 1 / fps if fps > 0 else 0
+        self._next_time = time.time()
+
+    def capture_into(self, out):
+        import cv2
+
+        ok, frame = self._video.read()
+        if not ok:  # end of the video, restart it
+            self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self._video.read()
+            if not ok:
+                raise IOError("Cannot read the video " + self.path)
+        if self.realtime:
+            self._next_time += self._period
+            time.sleep(max(0.0, self._next_time - time.time()))
+        frame = cv2.resize(frame, (out.shape[1], out.shape[0]))
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=out)
+        return None
+
+    def close(self):
+        if self._video is not None:
+            self._video.release()
+
+
+class SyntheticSource(FrameSource):
+    """
+    Synthetic frames at a fixed frame rate: the given images in loop (e.g. recorded frames) or, if no
+    images are given, a moving gradient
+    """
+
+    def __init__(self, images=None, framerate=30):
+        self.images = images
+        self.framerate = framerate
+        self._count = 0
+        self._next_time = 0
+
+    def open(self):
+        self._next_time = time.time()
+
+    def capture_into(self, out):
+        self._next_time += 1 / self.framerate
+        time.sleep(max(0.0, self._next_time - time.time()))
+        if self.images:
+            np.copyto(out, self.images[self._count % len(self.images)])
+        else:
+            rows = np.arange(out.shape[0], dtype=np.uint16)[:, np.newaxis, np.newaxis]
+            out[...] = (rows + self._count) % 256
+        self._count += 1
+        return None
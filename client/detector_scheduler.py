@@ -0,0 +1,173 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PeriodicTask:
+    """
+    Task run by the DetectorScheduler at a fixed rate. The deadlines are computed from the first one
+    (start + k * period), so they never drift; if a run is still in progress at the next deadline, the deadline
+    is missed (the run is skipped, never queued). The function stops the task returning False
+    """
+
+    def __init__(self, name, function, period, start_time, duration=None):
+        self.name = name
+        self._function = function
+        self.period = period
+        self._start_time = start_time
+        self._end_time = start_time + duration if duration is not None else None
+        self._ticks = 0  # Number of deadlines passed
+        self._version = 0  # Incremented when the rate changes, to discard the deadline of the old rate
+        self._running = False
+        self._done = threading.Event()
+        # Statistics
+        self.runs = 0
+        self.missed_deadlines = 0
+        self.jitter = 0.0  # Total delay of the runs w.r.t. their deadlines
+        self.max_jitter = 0.0
+        self.run_time = 0.0  # Total duration of the runs
+
+    @property
+    def next_deadline(self):
+        return self._start_time + self._ticks * self.period
+
+    @property
+    def done(self):  # True when the task is completed or cancelled
+        return self._done.is_set()
+
+    def cancel(self):
+        self._done.set()
+
+    def wait(self, timeout=None):  # Waits for the completion (or cancellation) of the task
+        return self._done.wait(timeout)
+
+    def _expired(self, deadline):
+        return self._end_time is not None and deadline >= self._end_time
+
+    def _advance(self, now):
+        # next deadline after now, the deadlines already passed (the scheduler was late) are missed
+        self._ticks += 1
+        if self.next_deadline <= now:
+            late_ticks = int((now - self.next_deadline) // self.period) + 1
+            self.missed_deadlines += late_ticks
+            self._ticks += late_ticks
+
+    def _run(self, deadline):
+        if self.done:  # cancelled while waiting for a free thread
+            self._running = False
+            return
+        start_time = time.monotonic()
+        jitter = start_time - deadline
+        try:
+            if self._function() is False:
+                self._done.set()
+        except Exception as e:  # a failing task is stopped, the others go on
+            print(f"SCHEDULER - - {self.name} stopped: {e!r}")
+            self._done.set()
+        finally:
+            self.runs += 1
+            self.jitter += jitter
+            self.max_jitter = max(self.max_jitter, jitter)
+            self.run_time += time.monotonic() - start_time
+            self._running = False
+
+
+class DetectorScheduler:
+    """
+    Runs the detectors of the client as periodic tasks on a small pool of threads: a single timer thread
+    submits every task at its deadlines, so a blocking round trip to the server of a task never delays the others
+    """
+
+    def __init__(self, max_workers=4):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="detector")
+        self._deadlines = []  # Heap of (deadline, id, version, task)
+        self._ids = itertools.count()
+        self._tasks = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._timer_thread = threading.Thread(target=self._timer, daemon=True)
+        self._timer_thread.start()
+
+    def schedule(self, name, function, frequency, duration=None, delay=0.0):
+        """
+        Runs function frequency times per second, starting after delay seconds and (if duration is given)
+        for duration seconds. Returns the PeriodicTask, that can be waited or cancelled
+        """
+        task = PeriodicTask(name, function, 1 / frequency, time.monotonic() + delay, duration)
+        with self._condition:
+            self._tasks.append(task)
+            self._push(task)
+        return task
+
+    def set_frequency(self, task, frequency):
+        """
+        Changes the rate of the task: the next run is one new period after the last deadline (or immediately,
+        if it is already passed), then the deadlines follow the new rate without drift
+        """
+        with self._condition:
+            if task.done or task.period == 1 / frequency:
+                return
+            last_deadline = task.next_deadline - task.period
+            task.period = 1 / frequency
+            task._start_time = max(last_deadline + task.period, time.monotonic())
+            task._ticks = 0
+            task._version += 1
+            self._push(task)
+
+    def _push(self, task):
+        heapq.heappush(self._deadlines, (task.next_deadline, next(self._ids), task._version, task))
+        self._condition.notify()
+
+    def _timer(self):
+        with self._condition:
+            while not self._stopped:
+                if len(self._deadlines) == 0:
+                    self._condition.wait()
+                    continue
+                deadline, _, version, task = self._deadlines[0]
+                now = time.monotonic()
+                if deadline > now:
+                    self._condition.wait(deadline - now)
+                    continue
+                heapq.heappop(self._deadlines)
+                if task.done or version != task._version:
+                    continue
+                if task._expired(deadline):
+                    task._done.set()
+                    continue
+                if task._running:  # the previous run is not completed
+                    task.missed_deadlines += 1
+                else:
+                    task._running = True
+                    self._executor.submit(task._run, deadline)
+                task._advance(now)
+                self._push(task)
+
+    def shutdown(self):  # Cancels all the tasks and waits for the runs in progress
+        with self._condition:
+            self._stopped = True
+            for task in self._tasks:
+                task.cancel()
+            self._condition.notify()
+        self._timer_thread.join()
+        self._executor.shutdown(wait=True)
+
+    def report(self):  # Runs, missed deadlines, jitter and run time of the tasks, grouped by name
+        report = {}
+        with self._condition:
+            tasks = list(self._tasks)
+        for task in tasks:
+            stats = report.setdefault(task.name, {"runs": 0, "missed_deadlines": 0, "jitter": 0.0,
+                                                  "max_jitter": 0.0, "run_time": 0.0})
+            stats["runs"] += task.runs
+            stats["missed_deadlines"] += task.missed_deadlines
+            stats["jitter"] += task.jitter
+            stats["max_jitter"] = max(stats["max_jitter"], task.max_jitter)
+            stats["run_time"] += task.run_time
+        for stats in report.values():
+            runs = stats["runs"]
+            stats["avg_jitter"] = stats.pop("jitter") / runs if runs > 0 else 0
+            stats["avg_run_time"] = stats.pop("run_time") / runs if runs > 0 else 0
+        return report
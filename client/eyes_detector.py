@@ -1,76 +1,135 @@
-import copy
 import time
-from threading import Thread
 
 import globals as glob
 import socket_communication
+from client.frame_gate import FrameGate
 from client.mood_detector import MoodDetector
 
 
-class EyesDetector(Thread):
-    def __init__(self, frequency, num_cons_frame):
-        super(EyesDetector, self).__init__()
-        self.frequency = frequency  # frequency of the detection
+class SamplingPolicy:
+    """
+    Adaptive rate of the need detection: slow while the detected eyes agree with the mode of the user, fast as
+    soon as a detection disagrees (to confirm the change with the consecutive frames quickly), and halved at
+    every detection without faces down to min_frequency
+    """
+
+    def __init__(self, stable_frequency=0.5, fast_frequency=4, min_frequency=0.1):
+        self.stable_frequency = stable_frequency
+        self.fast_frequency = fast_frequency
+        self.min_frequency = min_frequency
+
+    def next_frequency(self, frequency, detection, actual_state):
+        if detection == -1:  # No faces in front of the camera
+            return max(self.min_frequency, min(frequency, self.stable_frequency) / 2)
+        if detection != actual_state:
+            return self.fast_frequency
+        return self.stable_frequency
+
+
+class EyesDetector:
+    def __init__(self, scheduler, num_cons_frame, policy=None, mood_gate=None):
+        self._scheduler = scheduler  # DetectorScheduler running the detectors
         self.num_cons_frame = num_cons_frame  # Number of consecutive frames to be used for changing class
+        self.policy = policy if policy is not None else SamplingPolicy()
+        self.frequency = self.policy.stable_frequency  # actual frequency of the detection
+        # Every new frame is classified (a closure of the eyes is too small for a FrameGate), the frames of the
+        # mood checks that did not change reuse the last mood (the gate is shared by the mood checks)
+        self.mood_gate = mood_gate if mood_gate is not None else FrameGate("M", max_skips=2)
+        self._act_cons_frame = 1
+        self._prev_detection = None
+        self._last_seq = 0
+        self._task = None
+        self._mood_task = None  # Mood check started by the last change of position
+        # Statistics: inferences requested to the server and latency of the changes of mode
+        self._inferences = 0
+        self._latencies = []
+        self._last_agreement = None  # Time of the last detection that agreed with the mode of the user
 
-    def run(self):
+    def start(self):  # Runs the eyes detector at the rate of its policy, returns the PeriodicTask
+        self._last_agreement = time.time()
+        self._task = self._scheduler.schedule("need-detection", self.step, self.frequency)
+        return self._task
+
+    def _set_frequency(self, detection, actual_state):
+        self.frequency = self.policy.next_frequency(self.frequency, detection, actual_state)
+        self._scheduler.set_frequency(self._task, self.frequency)
+
+    def report(self):
         """
-        Thread that handles the eyes detector, with a certain frequency looks the frame
-        and checks if for a certain number of frames closed or open eyes are detected
+        Inferences spent against latency of the changes of mode (time from the last detection agreeing with the
+        previous mode, an upper bound of the time the change of the eyes waited to be confirmed)
         """
-        # 1) while true + sleep(frequency)
-        act_cons_frame = 1
-        prev_detection = None
-        while not glob.stop_flag:
-            time.sleep(1 / self.frequency)
-            start_time = time.time()
-            # 2) took the actual frame (lock)
-            with glob.shared_frame_lock:
-                actual_frame_cp = copy.deepcopy(glob.actual_frame)
-            # 3) classify the frame
-            with glob.controller.socket_lock:
-                socket_communication.send({"type": "need-detection", "frame": actual_frame_cp.tobytes()})
-                current_detection = socket_communication.recv("N")["payload"]
-            with open("eyes_log.csv", "a") as f:
-                f.write(str(time.time() - start_time) + "\n")
-            if current_detection == -1:  # No faces in front of the camera
-                act_cons_frame = 1
-                continue
-            with glob.user_lock:
-                actual_state = glob.logged_user.get_mode()
-            # increment the number of actual consecutive frame only if the actual detection
-            # is different from the actual state and the detection is equal to the previous one
-            if actual_state != current_detection and prev_detection == current_detection:
-                act_cons_frame += 1
-            else:
-                act_cons_frame = 1
+        return {"inferences": self._inferences,
+                "changes": len(self._latencies),
+                "inferences_per_change": self._inferences / len(self._latencies) if self._latencies else None,
+                "avg_latency": sum(self._latencies) / len(self._latencies) if self._latencies else None,
+                "max_latency": max(self._latencies) if self._latencies else None,
+                "frequency": self.frequency}
 
-            if act_cons_frame >= self.num_cons_frame:
-                act_cons_frame = 1
-                # 4) if for num_consecutive_frame you have detected closed eyes
-                if current_detection == 1:
-                    # 4.1) put the seat in the preferred position for sleeping
-                    with glob.user_lock:
-                        glob.logged_user.set_mode(True)
-                        position = glob.logged_user.get_position()
-                    glob.controller.rotate_back_seat(position, True)
-                    # 4.2) print on the data the message
-                    glob.controller.add_log_message(f"NEED DETECTOR - - SLEEP position set")
-                # 5) if for num_consecutive_frame you have detected open eyes
-                else:
-                    # 5.1) put the seat in the preferred position for awakening
-                    with glob.user_lock:
-                        glob.logged_user.set_mode(False)
-                        position = glob.logged_user.get_position()
-                    glob.controller.rotate_back_seat(position, True)
-                    # 5.2) print on the data the message
-                    glob.controller.add_log_message(f"NEED DETECTOR - - AWAKE position set")
+    def step(self):
+        """
+        One detection of the eyes detector: looks the frame and checks if for a certain number of frames
+        closed or open eyes are detected
+        """
+        # 1) took the newest frame, not already processed
+        with glob.frame_buffer.read(newer_than=self._last_seq, timeout=0) as frame:
+            if frame is None:  # No new frame from the camera
+                return
+            self._last_seq = frame.seq
+            # 2) classify the frame
+            future = socket_communication.request({"type": "need-detection", "frame": frame.image,
+                                                   "jpeg": frame.jpeg, "frame_id": frame.seq}, "N")
+        self._inferences += 1
+        try:
+            current_detection = future.result()["payload"]
+        except socket_communication.ServerError as e:  # the frame is skipped, the detection goes on
+            glob.controller.add_log_message(f"NEED DETECTOR - - Server error: {e}")
+            return
+        with glob.user_lock:
+            actual_state = glob.logged_user.get_mode()
+        self._set_frequency(current_detection, actual_state)
+        if current_detection == -1:  # No faces in front of the camera
+            self._act_cons_frame = 1
+            return
+        if current_detection == actual_state:
+            self._last_agreement = time.time()
+        # increment the number of actual consecutive frame only if the actual detection
+        # is different from the actual state and the detection is equal to the previous one
+        if actual_state != current_detection and self._prev_detection == current_detection:
+            self._act_cons_frame += 1
+        else:
+            self._act_cons_frame = 1
 
-                # 6) start the mood detector thread, that checks if the user doesn't like
-                #    the changed position and eventually restore the previous one
+        if self._act_cons_frame >= self.num_cons_frame:
+            self._act_cons_frame = 1
+            self._latencies.append(time.time() - self._last_agreement)
+            self._last_agreement = time.time()
+            # 3) if for num_consecutive_frame you have detected closed eyes
+            if current_detection == 1:
+                # 3.1) put the seat in the preferred position for sleeping
+                with glob.user_lock:
+                    glob.logged_user.set_mode(True)
+                    position = glob.logged_user.get_position()
+                glob.controller.rotate_back_seat(position, True)
+                # 3.2) print on the data the message
+                glob.controller.add_log_message(f"NEED DETECTOR - - SLEEP position set")
+            # 4) if for num_consecutive_frame you have detected open eyes
+            else:
+                # 4.1) put the seat in the preferred position for awakening
                 with glob.user_lock:
-                    actual_state = glob.logged_user.get_mode()
-                mood_detector = MoodDetector(5, 1, actual_state)
-                mood_detector.start()
-                mood_detector.join()
-            prev_detection = current_detection
+                    glob.logged_user.set_mode(False)
+                    position = glob.logged_user.get_position()
+                glob.controller.rotate_back_seat(position, True)
+                # 4.2) print on the data the message
+                glob.controller.add_log_message(f"NEED DETECTOR - - AWAKE position set")
+
+            # 5) start the mood detector, that checks (while the eyes are still monitored) if the user doesn't
+            #    like the changed position and eventually restore the previous one. The check of the previous
+            #    change, if still running, is no more meaningful
+            if self._mood_task is not None:
+                self._mood_task.cancel()
+            with glob.user_lock:
+                actual_state = glob.logged_user.get_mode()
+            self._mood_task = MoodDetector(5, 1, actual_state, self.mood_gate).start(self._scheduler)
+            self._set_frequency(current_detection, actual_state)  # the eyes agree with the new mode
+        self._prev_detection = current_detection
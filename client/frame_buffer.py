@@ -0,0 +1,96 @@
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Frame:
+    def __init__(self, seq, image, jpeg):
+        self.seq = seq  # Sequence number of the frame (increasing, 0 means no frame)
+        self.image = image  # Read-only view of the frame
+        self.jpeg = jpeg  # JPEG of the frame as produced by the camera (None if not available)
+
+
+class FrameRingBuffer:
+    """
+    Preallocated ring of frame slots shared by the camera (writer) and the detectors (readers).
+    The writer fills a slot that is neither the latest frame nor in use by a reader, then publishes it with a
+    new sequence number. Readers get a read-only view of the latest frame without copies, and the slot is
+    pinned (never overwritten) while they use it. The lock only protects the bookkeeping of the slots:
+    no copies, encodings or GUI updates are done while holding it
+    """
+
+    def __init__(self, shape=(540, 432, 3), num_slots=8, dtype=np.uint8):
+        self._frames = np.zeros((num_slots,) + tuple(shape), dtype=dtype)
+        self._jpegs = [None] * num_slots
+        self._seqs = [0] * num_slots
+        self._pins = [0] * num_slots  # Number of readers using each slot
+        self._latest = -1  # Slot of the latest frame
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._new_frame = threading.Condition(self._lock)
+        self._slot_released = threading.Condition(self._lock)  # a reader released a slot
+
+    @property
+    def latest_seq(self):
+        return self._seq
+
+    def _free_slot(self):  # A slot that is neither the latest frame nor pinned (None if all are in use)
+        for offset in range(1, len(self._pins) + 1):
+            slot = (self._latest + offset) % len(self._pins)
+            if slot != self._latest and self._pins[slot] == 0:
+                return slot
+        return None
+
+    def begin_write(self, timeout=None):
+        """
+        Returns a free slot and its (writable) frame, to be filled by the writer and published with commit.
+        If all the slots are in use, it waits for a reader to release one at most timeout seconds
+        (it returns None, None if none is released)
+        """
+        with self._slot_released:
+            if not self._slot_released.wait_for(lambda: self._free_slot() is not None, timeout):
+                return None, None
+            slot = self._free_slot()
+            self._seqs[slot] = 0  # the slot is being written
+            return slot, self._frames[slot]
+
+    def commit(self, slot, jpeg=None):  # Publishes the frame written in the slot as the latest one
+        with self._new_frame:
+            self._seq += 1
+            self._seqs[slot] = self._seq
+            self._jpegs[slot] = jpeg
+            self._latest = slot
+            self._new_frame.notify_all()
+        return self._seq
+
+    def write(self, image, jpeg=None):  # Copies the image in a free slot and publishes it
+        slot, frame = self.begin_write()  # waits for a free slot
+        np.copyto(frame, image)
+        return self.commit(slot, jpeg)
+
+    @contextmanager
+    def read(self, newer_than=0, timeout=None):
+        """
+        Context manager that gives the latest frame with a sequence number greater than newer_than, waiting
+        for it at most timeout seconds (it gives None if there is no such frame). The frame must not be used
+        outside the context
+        """
+        with self._new_frame:
+            if not self._new_frame.wait_for(lambda: self._seq > newer_than, timeout):
+                slot = None
+            else:
+                slot = self._latest
+                self._pins[slot] += 1
+        if slot is None:
+            yield None
+            return
+        try:
+            image = self._frames[slot].view()
+            image.flags.writeable = False
+            yield Frame(self._seqs[slot], image, self._jpegs[slot])
+        finally:
+            with self._slot_released:
+                self._pins[slot] -= 1
+                if self._pins[slot] == 0:
+                    self._slot_released.notify()
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class FrameGate:
+    """
+    Client side change detection for a request type: a frame is sent to the server only if it differs enough
+    from the last frame sent, otherwise the last result of the server is reused. The frames are compared through
+    a size x size grayscale thumbnail (mean of blocks of pixels), skipping only when no block changed by
+    threshold gray levels or more: the changes of the face (eyes, mouth) cover a few blocks, and a mean over the
+    whole thumbnail would dilute them below the camera noise. After max_skips consecutive skips a frame is sent
+    anyway, so slow changes are not missed. The need detection does not use a gate: a closure of the eyes can
+    be too small even for a single block
+    """
+
+    def __init__(self, phase, threshold=6.0, size=24, max_skips=10):
+        self.phase = phase  # Phase of the request type (see socket_communication.PHASES)
+        self.threshold = threshold
+        self.size = size
+        self.max_skips = max_skips
+        self._reference = None  # Thumbnail of the last frame sent
+        self._result = None  # Result of the last frame sent
+        self._skips = 0
+        self.frames = 0
+        self.skipped = 0
+
+    @property
+    def result(self):  # Result of the server for the last frame sent
+        return self._result
+
+    def thumbnail(self, image):
+        block_height, block_width = image.shape[0] // self.size, image.shape[1] // self.size
+        blocks = image[:block_height * self.size, :block_width * self.size]
+        blocks = blocks.reshape(self.size, block_height, self.size, block_width, -1)
+        return blocks.mean(axis=(1, 3, 4), dtype=np.float32)
+
+    def skip(self, thumbnail):  # True if the frame can reuse the last result instead of being sent
+        self.frames += 1
+        if self._reference is not None and self._skips < self.max_skips and \
+                np.abs(thumbnail - self._reference).max() < self.threshold:
+            self._skips += 1
+            self.skipped += 1
+            return True
+        return False
+
+    def update(self, thumbnail, result):  # Stores the result of the server for the frame sent
+        self._reference = thumbnail
+        self._result = result
+        self._skips = 0
+
+    def report(self, codec_stats=None):
+        """
+        Skip ratio and inferences saved. The bytes saved are estimated with the average size on the wire
+        of the frames of the phase, if the CodecStats of the encoder are given
+        """
+        report = {"frames": self.frames,
+                  "skipped": self.skipped,
+                  "skip_ratio": self.skipped / self.frames if self.frames > 0 else 0,
+                  "inferences_saved": self.skipped}
+        if codec_stats is not None:
+            phase_stats = codec_stats.report().get(self.phase)
+            if phase_stats is not None:
+                report["bytes_saved"] = self.skipped * phase_stats["wire_bytes"] // phase_stats["frames"]
+        return report
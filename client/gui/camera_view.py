@@ -1,10 +1,12 @@
+import time
 import tkinter as tk
+
 import numpy as np
 from PIL import Image, ImageTk
 
 
 class CameraView:
-    def __init__(self, master):
+    def __init__(self, master, display_rate=15, frame_size=(432, 540)):
         self.master = master
         self.frame = tk.Frame(master)
         # create the window containing the camera frame
@@ -12,13 +14,38 @@ class CameraView:
         self.frame.pack(side=tk.LEFT)
         self.image_label.pack()
 
-        self.update_image(np.empty(shape=(576, 432, 3)))
+        # a single PhotoImage is created and the frames are pasted into it
+        self.photo = ImageTk.PhotoImage(Image.new("RGB", frame_size, "white"))
+        self.image_label.configure(image=self.photo)
+        self._display_period = 1 / display_rate  # seconds between two refreshes of the view
+        self._frame_buffer = None
+        self._last_seq = 0
+        self.displayed_frames = 0
+        self.skipped_frames = 0  # frames captured but not displayed
+
+    def start(self, frame_buffer):
+        """
+        Starts displaying the frames of the buffer: the Tk main loop pulls the latest frame at the display rate,
+        so the camera never waits for the rendering
+        """
+        self._frame_buffer = frame_buffer
+        self.master.after(0, self._refresh)
+
+    def _refresh(self):
+        start_time = time.time()
+        with self._frame_buffer.read(newer_than=self._last_seq, timeout=0) as frame:
+            if frame is not None:
+                # the frames arrived since the last refresh, except the latest one, are skipped
+                self.skipped_frames += frame.seq - self._last_seq - 1
+                self._last_seq = frame.seq
+                self.update_image(frame.image)
+                self.displayed_frames += 1
+        # if the rendering was slow, the next refresh is anticipated to keep the display rate
+        delay = max(1, int((self._display_period - (time.time() - start_time)) * 1000))
+        self.master.after(delay, self._refresh)
 
     def update_image(self, img):
         """
-        This method update the window with the frame inside img
+        This method update the window with the frame inside img (it must be called by the Tk thread)
         """
-        image = Image.fromarray(img.astype("uint8"))
-        photo = ImageTk.PhotoImage(image)
-        self.image_label.configure(image=photo)
-        self.image_label.image = photo
+        self.photo.paste(Image.fromarray(np.asarray(img, dtype=np.uint8)))
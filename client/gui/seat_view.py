@@ -1,4 +1,4 @@
-import time
+import queue
 import tkinter as tk
 
 from PIL import ImageTk, Image
@@ -7,6 +7,11 @@ import globals as glob
 
 
 class SeatView:
+    STEP = 10  # degrees of a step of the animation
+    STEP_INTERVAL = 500  # milliseconds between two steps of the animation
+    POLL_INTERVAL = 50  # milliseconds between two checks of the rotation commands
+    MIN_DEGREE, MAX_DEGREE = -90, 90  # range of the sprites rendered at startup
+
     def __init__(self, master):
         self.master = master
         self.frame = tk.Frame(master, bg="white")
@@ -18,9 +23,17 @@ class SeatView:
 
         # create the image related to the back seat
         self.back_seat = self.back_seat.resize((600, 300))
-        self.back_seat_tk = ImageTk.PhotoImage(self.back_seat)
-        self.canvas_back_seat = self.canvas.create_image(15, 350, anchor=tk.SW, image=self.back_seat_tk)
-        self.actual_degree = 0
+        # the rotated back seats are rendered once, the animation only changes the displayed sprite
+        self._sprites = {}
+        for degree in range(SeatView.MIN_DEGREE, SeatView.MAX_DEGREE + 1, SeatView.STEP):
+            self._get_sprite(degree)
+        self.canvas_back_seat = self.canvas.create_image(15, 350, anchor=tk.SW, image=self._get_sprite(0))
+        self.actual_degree = 0  # degree displayed
+        self._target_degree = 0  # degree the animation is moving to
+        self._animating = False
+        # rotation commands sent by the other threads, executed by the Tk event loop
+        self._commands = queue.Queue()
+        self.master.after(SeatView.POLL_INTERVAL, self._poll_commands)
 
         # create the image related to the seat
         self.seat = self.seat.resize((150, 60))
@@ -44,26 +57,51 @@ class SeatView:
 
         self.frame.pack(side=tk.TOP)
 
+    def _get_sprite(self, degree):
+        # degrees outside the prerendered range (reachable with the arrows) are rendered once when needed
+        if degree not in self._sprites:
+            rotated_image = self.back_seat.rotate(degree, resample=Image.BICUBIC,
+                                                  center=((self.back_seat.width // 2) - 27,
+                                                          self.back_seat.height - 72))
+            self._sprites[degree] = ImageTk.PhotoImage(rotated_image)
+        return self._sprites[degree]
+
     def rotate(self, degrees, absolute):
-        if not absolute:  # relative degrees
-            self.actual_degree += degrees
-        else:  # absolute degree (progressive change of the seat, 10 degrees at a time)
-            direction = 1
-            if self.actual_degree < degrees:
-                min = self.actual_degree
-                max = degrees
-            elif self.actual_degree > degrees:
-                max = self.actual_degree
-                min = degrees
-                direction = -1
-            for i in range(min, max, 10):
-                self.rotate(10 * direction, False)
-                time.sleep(0.5)
-        rotated_image = self.back_seat.rotate(self.actual_degree, resample=Image.BICUBIC,
-                                              center=((self.back_seat.width // 2) - 27, self.back_seat.height - 72))
-        rotated_image_tk = ImageTk.PhotoImage(rotated_image)
-        self.canvas.itemconfig(self.canvas_back_seat, image=rotated_image_tk)
-        self.back_seat_tk = rotated_image_tk
+        """
+        Rotates the back seat (it can be called by any thread and returns immediately). With absolute degrees
+        the seat moves progressively, 10 degrees at a time, and a new target replaces the one of the
+        animation in progress; relative degrees are applied at once
+        """
+        self._commands.put((degrees, absolute))
+
+    def _poll_commands(self):
+        try:
+            while True:
+                degrees, absolute = self._commands.get_nowait()
+                if absolute:
+                    self._target_degree = degrees
+                else:  # relative degrees
+                    self._target_degree += degrees
+                    self._show(self.actual_degree + degrees)
+        except queue.Empty:
+            pass
+        if not self._animating and self.actual_degree != self._target_degree:
+            self._animating = True
+            self._animation_step()
+        self.master.after(SeatView.POLL_INTERVAL, self._poll_commands)
+
+    def _animation_step(self):
+        difference = self._target_degree - self.actual_degree
+        if difference == 0:
+            self._animating = False
+            return
+        step = max(-SeatView.STEP, min(SeatView.STEP, difference))
+        self._show(self.actual_degree + step)
+        self.master.after(SeatView.STEP_INTERVAL, self._animation_step)
+
+    def _show(self, degree):
+        self.actual_degree = degree
+        self.canvas.itemconfig(self.canvas_back_seat, image=self._get_sprite(degree))
 
     def change_button(self, status):
         if status:  # if status is True, able the clickable arrows
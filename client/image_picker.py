@@ -1,34 +1,51 @@
-import io
 import time
 from threading import Thread
 
-import numpy as np
-from PIL import Image
-from picamera import PiCamera
-
 import globals as glob
+import metrics
+from client.camera_source import PiCameraSource
 
 
 class ImagePicker(Thread):
-    def __init__(self, frequency=100):
+    def __init__(self, source=None):
         super(ImagePicker, self).__init__()
-        self._camera = PiCamera()
-        time.sleep(2)
-        self._camera.hflip = True
-        self._camera.resolution = (432, 540)
-        self._frequency = frequency
-
-    def capture_image(self):  # Capture the image and returns it as a numpy array
-        img = io.BytesIO()
-        self._camera.capture(img, format="jpeg")
-        img_pil = Image.open(img)
-        return np.array(img_pil)
+        # Source of the frames, the PiCamera streaming from the video port by default
+        self._source = source if source is not None else PiCameraSource()
+        self._frames = 0
+        self._slot_waits = 0  # Times all the slots of the buffer were in use (the frame is captured later)
+        self._capture_time = 0.0  # Total time spent waiting for the frames
+        self._max_capture_time = 0.0
+        self._start_time = None
 
     def run(self):
-        while not glob.stop_flag:
-            time.sleep(1/self._frequency)
-            image = self.capture_image()
-            with glob.shared_frame_lock:
-                glob.actual_frame = image
-                if not glob.stop_flag:
-                    glob.controller.update_camera(glob.actual_frame)
+        """
+        Thread that publishes the frames in the frame buffer as soon as the source produces them:
+        every frame is captured directly into a free slot of the buffer (the GUI pulls them, see CameraView)
+        """
+        self._source.open()
+        self._start_time = time.time()
+        try:
+            while not glob.stop_flag:
+                # the readers release their slots quickly, but the stop flag is checked while waiting
+                slot, image = glob.frame_buffer.begin_write(timeout=0.5)
+                if slot is None:
+                    self._slot_waits += 1
+                    continue
+                start_time = time.time()
+                jpeg = self._source.capture_into(image)
+                capture_time = time.time() - start_time
+                glob.frame_buffer.commit(slot, jpeg)
+                metrics.record("client", "", "capture", capture_time)
+                self._frames += 1
+                self._capture_time += capture_time
+                self._max_capture_time = max(self._max_capture_time, capture_time)
+        finally:
+            self._source.close()
+
+    def report(self):  # Achieved frame rate and capture latency
+        elapsed = time.time() - self._start_time if self._start_time is not None else 0
+        return {"frames": self._frames,
+                "fps": self._frames / elapsed if elapsed > 0 else 0,
+                "avg_capture_time": self._capture_time / self._frames if self._frames > 0 else 0,
+                "max_capture_time": self._max_capture_time,
+                "slot_waits": self._slot_waits}
@@ -1,59 +1,74 @@
-import copy
-import time
 import globals as glob
-from threading import Thread
 import socket_communication
+from client.frame_gate import FrameGate
 
-class MoodDetector(Thread):
-    def __init__(self, tot_seconds, frequency, user_state):
-        super(MoodDetector, self).__init__()
+class MoodDetector:
+    def __init__(self, tot_seconds, frequency, user_state, gate=None):
         self._bad_emotions = ["angry", "disgust", "sad", "fear"]
         self.tot_seconds = tot_seconds
         self.frequency = frequency
         self.user_state = user_state
+        # Frames that did not change reuse the last mood (a check lasts a few frames, so few consecutive skips)
+        self._gate = gate if gate is not None else FrameGate("M", max_skips=2)
+        self._last_seq = 0
+        self._task = None
 
-    def get_mood(self, img):  # It returns the emotion and 1 if the detected emotion was "bad", 0 otherwise
-        with glob.controller.socket_lock:
-            socket_communication.send({"type": "mood-detection", "frame": img.tobytes()})
-            emotion = socket_communication.recv("M")["payload"]
+    def get_mood(self, frame):  # Returns the emotion and 1 if the detected emotion was "bad", 0 otherwise
+        future = socket_communication.request({"type": "mood-detection", "frame": frame.image, "jpeg": frame.jpeg,
+                                               "frame_id": frame.seq}, "M")
+        emotion = future.result()["payload"]
         if emotion in self._bad_emotions:  # If the user didn't appreciate the change of seat position by system
             return emotion, 1
         return emotion, 0  # The user appreciated the change of seat position by system
 
-    def run(self):
+    def start(self, scheduler):
         """
-        Thread that handles the mood detector, with a certain frequency look the frame
-        and checks if the user doesn't like the changed position
+        Runs the mood detector for tot_seconds at its frequency (the first check after one period),
+        returns the PeriodicTask that can be cancelled
         """
-        # 1) while(tot_sec)
-        act_seconds = 0
-        while act_seconds < self.tot_seconds:
-            time.sleep(1 / self.frequency)
-            start_time = time.time()
-            act_seconds += (1 / self.frequency)
-            # 2) took the actual frame
-            with glob.shared_frame_lock:
-                actual_frame_cp = copy.deepcopy(glob.actual_frame)
-            # 3) classify the frame
-            emotion, class_emotion = self.get_mood(actual_frame_cp)
-            with open("mood_detector.csv", "a") as f:
-                f.write(str(time.time() - start_time) + "\n")
-            # 4) print in the data the emotion detected
-            glob.controller.add_log_message(f"MOOD DETECTOR - - {emotion} detected")
-            # 5) if the detected emotion is a bad emotion
-            if class_emotion == 1:
-                # 5.1) restore the previous position
-                if self.user_state:  # if user_state is True (seat is in sleep position) restore the awake position
-                    with glob.user_lock:
-                        glob.logged_user.set_mode(False)
-                        position = glob.logged_user.get_position()
-                        mode = "AWAKE"
-                else:  # The user state is False (seat is in awake position) restore the sleep position
-                    with glob.user_lock:
-                        glob.logged_user.set_mode(True)
-                        position = glob.logged_user.get_position()
-                        mode = "SLEEP"
-                glob.controller.rotate_back_seat(position, True)
-                # 5.2) print in the data that the position is changed
-                glob.controller.add_log_message(f"MOOD DETECTOR - - Previous position restored (" + mode + ")")
+        self._task = scheduler.schedule("mood-detection", self.step, self.frequency, duration=self.tot_seconds,
+                                        delay=1 / self.frequency)
+        return self._task
+
+    def step(self):
+        """
+        One check of the mood detector: looks the frame and checks if the user doesn't like the changed position
+        """
+        # 1) took the newest frame, not already processed
+        with glob.frame_buffer.read(newer_than=self._last_seq, timeout=0) as frame:
+            if frame is None:  # No new frame from the camera
                 return
+            self._last_seq = frame.seq
+            thumbnail = self._gate.thumbnail(frame.image)
+            skip = self._gate.skip(thumbnail)
+            if not skip:  # 2) classify the frame, if it changed
+                try:
+                    emotion, class_emotion = self.get_mood(frame)
+                except socket_communication.ServerError as e:  # the frame is skipped, the check goes on
+                    glob.controller.add_log_message(f"MOOD DETECTOR - - Server error: {e}")
+                    return
+        if skip:  # same mood of the last frame sent
+            emotion, class_emotion = self._gate.result
+        else:
+            self._gate.update(thumbnail, (emotion, class_emotion))
+        if self._task is not None and self._task.done:  # the check was cancelled while waiting for the server
+            return False
+        # 3) print in the data the emotion detected
+        glob.controller.add_log_message(f"MOOD DETECTOR - - {emotion} detected")
+        # 4) if the detected emotion is a bad emotion
+        if class_emotion == 1:
+            # 4.1) restore the previous position
+            if self.user_state:  # if user_state is True (seat is in sleep position) restore the awake position
+                with glob.user_lock:
+                    glob.logged_user.set_mode(False)
+                    position = glob.logged_user.get_position()
+                    mode = "AWAKE"
+            else:  # The user state is False (seat is in awake position) restore the sleep position
+                with glob.user_lock:
+                    glob.logged_user.set_mode(True)
+                    position = glob.logged_user.get_position()
+                    mode = "SLEEP"
+            glob.controller.rotate_back_seat(position, True)
+            # 4.2) print in the data that the position is changed
+            glob.controller.add_log_message(f"MOOD DETECTOR - - Previous position restored (" + mode + ")")
+            return False
@@ -0,0 +1,83 @@
+import threading
+
+import socket_communication
+
+
+class PositionSync:
+    """
+    Sends to the server the adjustments of the seat position made by the user, so that the profile on the server
+    is always up to date. The deltas are coalesced per mode (awake and sleep) and sent in a single 'position-delta'
+    message at every flush, run periodically by the scheduler: the GUI only adds the delta and never waits
+    """
+
+    def __init__(self, scheduler, frequency=1):
+        self._scheduler = scheduler
+        self.frequency = frequency
+        self._lock = threading.Lock()
+        self._name = None
+        self._deltas = [0, 0]  # awake, sleep
+        self.adjustments = 0
+        self.batches = 0
+
+    def start(self):  # Flushes the deltas periodically, returns the PeriodicTask
+        return self._scheduler.schedule("position-sync", self.flush, self.frequency)
+
+    def add(self, name, mode, delta):  # Adds the delta of the position of the mode (False: AWAKE, True: SLEEP)
+        with self._lock:
+            self._name = name
+            self._deltas[int(mode)] += delta
+            self.adjustments += 1
+
+    def _take(self):  # Name and deltas coalesced since the last flush
+        with self._lock:
+            name, (awake_delta, sleep_delta) = self._name, self._deltas
+            self._deltas = [0, 0]
+        return name, awake_delta, sleep_delta
+
+    def _request(self, name, awake_delta, sleep_delta):
+        try:
+            future = socket_communication.request({"type": "position-delta", "name": name, "awake": awake_delta,
+                                                   "sleep": sleep_delta})
+        except OSError:
+            with self._lock:  # not sent: kept for the next flush
+                self._deltas[0] += awake_delta
+                self._deltas[1] += sleep_delta
+            raise
+        self.batches += 1
+        return future
+
+    def flush(self):
+        """
+        Sends the deltas coalesced since the last flush, without waiting for the reply. Returns the future of the
+        request (None if there was nothing to send)
+        """
+        name, awake_delta, sleep_delta = self._take()
+        if awake_delta == 0 and sleep_delta == 0:
+            return None
+        future = self._request(name, awake_delta, sleep_delta)
+        future.add_done_callback(lambda completed: self._restore(completed, name, awake_delta, sleep_delta))
+        return future
+
+    def flush_and_wait(self):
+        """
+        Sends the deltas not flushed yet and waits for the reply (at the end of the session). Returns the
+        deltas (awake, sleep) that the server did not save, (0, 0) if all were saved
+        """
+        name, awake_delta, sleep_delta = self._take()
+        if awake_delta == 0 and sleep_delta == 0:
+            return 0, 0
+        try:
+            self._request(name, awake_delta, sleep_delta).result()
+        except (OSError, socket_communication.ServerError):
+            return awake_delta, sleep_delta
+        return 0, 0
+
+    def _restore(self, future, name, awake_delta, sleep_delta):
+        # the deltas not applied by the server are sent again with the next batch
+        if future.exception() is not None:
+            with self._lock:
+                self._deltas[0] += awake_delta
+                self._deltas[1] += sleep_delta
+
+    def report(self):
+        return {"adjustments": self.adjustments, "batches": self.batches}
@@ -1,24 +1,33 @@
-import copy
-import pickle
+import os
 import socket
 import threading
 import time
 import tkinter as tk
+import uuid
+
+import numpy as np
 
 import globals as glob
+import metrics
 import socket_communication
+from client.detector_scheduler import DetectorScheduler
 from client.eyes_detector import EyesDetector
 from client.gui.camera_view import CameraView
 from client.gui.rigth_side_view import RightSideView
 from client.gui.textfield_view import TextFieldView
 from client.image_picker import ImagePicker
+from client.position_sync import PositionSync
 from client.user_recognizer import UserRecognizer
 
-socket_communication.executor = "client"  # For testing (For computation of round trip time)
-
 class SeatComfortController:
     AWAKE_POSITION_DEFAULT = 0  # Position of the back seat when the user is awake
     SLEEPING_POSITION_DEFAULT = 60  # Degrees w.r.t "awake position" of the back seat when the user is sleeping
+    FRAME_CODECS = ["camera-jpeg", "jpeg", "raw"]  # Compression of the frames, in order of preference
+    FRAME_QUALITY = 80  # JPEG quality used when the frames have to be re-encoded
+    DISPLAY_RATE = 15  # Frames per second displayed in the camera view
+    ENROLLMENT_FRAMES = 8  # Frames of the burst sent at the sign up (the server keeps the sharpest faces)
+    ENROLLMENT_INTERVAL = 0.25  # Seconds between two frames of the burst
+    SEAT_ID_PATH = "data/seat_id"  # Identifier of the seat for the server, generated at the first start
 
     def __init__(self):
         # Initialize the GUI
@@ -26,13 +35,13 @@ class SeatComfortController:
         self.master.wm_title("Seat Comfort System")
         self.textfield_view = None
         self.right_side_view = None
-        self.camera_view = CameraView(self.master)
-        # Define the different threads that are needed
+        self.camera_view = CameraView(self.master, SeatComfortController.DISPLAY_RATE)
+        # Define the camera thread and the detectors, run as periodic tasks by the scheduler
         self._camera_thread = ImagePicker()
-        self._need_detector_thread = EyesDetector(1, 5)
-        self._user_recognizer_thread = UserRecognizer()
-
-        self.socket_lock = threading.Lock()
+        self._scheduler = DetectorScheduler()
+        self._need_detector = EyesDetector(self._scheduler, 5)
+        self._user_recognizer = UserRecognizer()
+        self._position_sync = PositionSync(self._scheduler)  # adjustments of the user sent to the server
 
     def main(self):
         self.textfield_view = TextFieldView(self.master)
@@ -41,67 +50,125 @@ class SeatComfortController:
         host = '169.254.232.238'
         port = 8000
         # Create a socket object
-        socket_communication.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Connect to the server
-        socket_communication.sock.connect((host, port))
+        sock.connect((host, port))
+        # executor "client": round trip and network time of the requests are recorded in the metrics
+        metrics.registry.start()
+        socket_communication.connection = socket_communication.Connection(sock, "client")
+        # Agree with the server on the compression of the frames
+        codec = socket_communication.connection.negotiate_codec(SeatComfortController.FRAME_CODECS,
+                                                                seat=self.seat_id(),
+                                                                quality=SeatComfortController.FRAME_QUALITY)
+        print("FRAME CODEC: " + codec)
+        # From now on the requests are multiplexed on the connection, replies are dispatched to their futures
+        socket_communication.connection.start_dispatcher()
+        status = socket_communication.request({"type": "status"}).result()["payload"]
+        self.add_log_message(f"SEAT COMFORT SYSTEM - - Server models " + status["state"])
         controller_thread = threading.Thread(target=self.run)  # start all the other threads
         controller_thread.start()
+        self.camera_view.start(glob.frame_buffer)  # the GUI displays the frames captured by the camera thread
         self.master.mainloop()  # start the GUI
         glob.stop_flag = True
-        if self._need_detector_thread.is_alive():
-            self._need_detector_thread.join()
-        if self._user_recognizer_thread.is_alive():
-            self._user_recognizer_thread.join()
+        self._scheduler.shutdown()  # stop the detectors
         if self._camera_thread.is_alive():
             self._camera_thread.join()
-        if glob.logged_user is not None:
-            with self.socket_lock:
-                socket_communication.send({"type": "save", "user": pickle.dumps(glob.logged_user)})
-                reply = socket_communication.recv()
-            if reply["payload"] == 0:
-                print("PROFILE SAVED ON THE SERVER")
-            socket_communication.sock.close()
+        print("CAMERA: " + str(self._camera_thread.report()))
+        print("SCHEDULER: " + str(self._scheduler.report()))
+        print("NEED DETECTOR: " + str(self._need_detector.report()))
+        gates = [self._user_recognizer.gate, self._need_detector.mood_gate]
+        codec_stats = socket_communication.connection.frame_encoder.stats
+        print("FRAME GATES: " + str({gate.phase: gate.report(codec_stats) for gate in gates}))
+        # the adjustments are already on the server, only the last ones (not flushed yet) are sent
+        unsaved = self._position_sync.flush_and_wait()
+        if unsaved == (0, 0):
+            print("LAST ADJUSTMENTS SAVED ON THE SERVER")
+        else:  # e.g. the server is gone
+            print(f"LAST ADJUSTMENTS NOT SAVED ON THE SERVER (awake {unsaved[0]:+d}, sleep {unsaved[1]:+d} degrees)")
+        print("POSITION SYNC: " + str(self._position_sync.report()))
+        socket_communication.connection.close()
+        metrics.registry.stop(path="data/metrics.jsonl")
+        print("METRICS:\n" + metrics.report())
+
+    @staticmethod
+    def seat_id():  # Identifier of this seat, the same at every start (the server keeps the last user of the seat)
+        if not os.path.exists(SeatComfortController.SEAT_ID_PATH):
+            with open(SeatComfortController.SEAT_ID_PATH, "w") as f:
+                f.write(uuid.uuid4().hex)
+        with open(SeatComfortController.SEAT_ID_PATH, "r") as f:
+            return f.read().strip()
 
     def run(self):
         # Start thread for capturing frames
         self._camera_thread.start()
         time.sleep(10)
-        # start the thread for the user recognition
-        self._user_recognizer_thread.start()
-        self._user_recognizer_thread.join()  # Wait for the user detection
+        # start the user recognition
+        self._user_recognizer.start(self._scheduler).wait()  # Wait for the user detection
         if not glob.stop_flag:
             self.change_button_status("signup", False)
             self.change_button_status("arrows", True)
-            self.add_log_message(f"SEAT COMFORT SYSTEM - - User detected: " + glob.logged_user.get_name() + " (AWAKE)")
-            self._need_detector_thread.start()
+            self.add_log_message(f"SEAT COMFORT SYSTEM - - User detected: " + glob.logged_user.get_name() +
+                                 f" (AWAKE, distance {self._user_recognizer.distance:.2f})")
+            self._need_detector.start()
+            self._position_sync.start()
+            self._user_recognizer.start_verification(self._scheduler)
 
     def signup_button_handler(self):
-        # handler for the signup button click
+        # handler for the signup button click, the burst is captured without blocking the GUI
         name = self.textfield_view.get_text()
-        with glob.shared_frame_lock:
-            img = copy.deepcopy(glob.actual_frame)
         if name != '':
-            with self.socket_lock:
-                socket_communication.send({"type": "sign-up", "name": name, "picture": img.tobytes()})
-                socket_communication.recv()  # Wait for the reply of the server (to wait for the completion of signup)
             self.change_button_status("signup", False)
+            threading.Thread(target=self.enroll, args=(name,), daemon=True).start()
+
+    def enroll(self, name):
+        """
+        Sends to the server a burst of frames of the user, taken ENROLLMENT_INTERVAL seconds apart. It runs in
+        its own thread: the widgets are updated by the GUI thread (through after)
+        """
+        signed_up = False
+        try:
+            pictures = []
+            last_seq = 0
+            while len(pictures) < SeatComfortController.ENROLLMENT_FRAMES:
+                with glob.frame_buffer.read(newer_than=last_seq) as frame:
+                    last_seq = frame.seq
+                    pictures.append(np.array(frame.image))
+                time.sleep(SeatComfortController.ENROLLMENT_INTERVAL)
+            future = socket_communication.request({"type": "sign-up", "name": name, "picture": np.stack(pictures)})
+            # Wait for the reply of the server (to wait for the completion of signup)
+            embeddings = future.result()["payload"]
+            if embeddings == -2:  # the name is already used by a registered user
+                message = f"SEAT COMFORT SYSTEM - - Sign up failed, " + name + " is already registered"
+            elif embeddings < 0:  # no sharp face in the burst, the user can try again
+                message = f"SEAT COMFORT SYSTEM - - Sign up failed, look at the camera and retry"
+            else:
+                message = f"SEAT COMFORT SYSTEM - - User " + name + " signed up"
+                signed_up = True
+        except (OSError, socket_communication.ServerError) as e:
+            message = f"SEAT COMFORT SYSTEM - - Sign up failed: {e!r}"
+        finally:
+            if not signed_up:  # the user can try again
+                self.master.after(0, self.change_button_status, "signup", True)
+        self.master.after(0, self.add_log_message, message)
 
     def left_arrow_handler(self, event):
         # handler for the left arrows, must rotate the seat of 10 degrees
         self.rotate_back_seat(10)
         with glob.user_lock:
             glob.logged_user.update_position_by_delta(10)
+            self._position_sync.add(glob.logged_user.get_name(), glob.logged_user.get_mode(), 10)
 
     def right_arrow_handler(self, event):
         # handler for the right arrows, must rotate the seat of -10 degrees
         self.rotate_back_seat(-10)
         with glob.user_lock:
             glob.logged_user.update_position_by_delta(-10)
+            self._position_sync.add(glob.logged_user.get_name(), glob.logged_user.get_mode(), -10)
 
     def rotate_back_seat(self, degrees,
                          absolute=False):  # when absolute is True, an absolute value for the degrees is passed
-        with glob.seat_position_lock:  # get the lock for changing the seat
-            self.right_side_view.get_seat_view().rotate(degrees, absolute)
+        # the rotation is queued and animated by the GUI, the caller is not blocked
+        self.right_side_view.get_seat_view().rotate(degrees, absolute)
 
     def add_log_message(self, message):
         with glob.log_lock:  # get the lock for writing in the data text area
@@ -113,10 +180,6 @@ class SeatComfortController:
         elif button == "arrows":
             self.right_side_view.get_seat_view().change_button(status)
 
-    def update_camera(self, img):
-        # update the image on the camera area of the window
-        self.camera_view.update_image(img)
-
 
 if __name__ == '__main__':
     glob.controller.main()
@@ -1,30 +1,67 @@
-import copy
-import pickle
-import time
-from threading import Thread
-
 import globals as glob
 import socket_communication
+from client.frame_gate import FrameGate
 
-class UserRecognizer(Thread):
-    def __init__(self, frequency=1):
-        super(UserRecognizer, self).__init__()
+class UserRecognizer:
+    def __init__(self, frequency=1, verify_frequency=0.2, gate=None):
         self._frequency = frequency
+        self._verify_frequency = verify_frequency  # Rate of the verification of the seated user
+        self._last_seq = 0
+        self.distance = None  # Distance of the match of the recognized user (lower is more confident)
+        self.gate = gate if gate is not None else FrameGate("U")  # Frames that did not change are not sent
+
+    def start(self, scheduler):  # Runs the recognition until the user is recognized, returns the PeriodicTask
+        return scheduler.schedule("user-recognition", self.step, self._frequency)
+
+    def start_verification(self, scheduler):
+        """
+        Verifies at a low rate that the recognized user is still the one on the seat (the server verifies the
+        faces of the last user of the seat without the face model), returns the PeriodicTask
+        """
+        return scheduler.schedule("user-verification", self.verify, self._verify_frequency,
+                                  delay=1 / self._verify_frequency)
+
+    def _recognize(self):
+        """
+        Sends the newest frame, if the scene changed since the last frame sent. Returns the reply of the server,
+        None if no frame was sent
+        """
+        # take the newest frame, not already processed
+        with glob.frame_buffer.read(newer_than=self._last_seq, timeout=0) as frame:
+            if frame is None:  # No new frame from the camera
+                return None
+            self._last_seq = frame.seq
+            thumbnail = self.gate.thumbnail(frame.image)
+            if self.gate.skip(thumbnail):  # same scene of the last frame sent
+                return None
+            future = socket_communication.request({"type": "user-recognition", "frame": frame.image,
+                                                   "jpeg": frame.jpeg, "frame_id": frame.seq}, "U")
+        try:
+            reply = future.result()
+        except socket_communication.ServerError as e:  # the frame is skipped, the recognition goes on
+            glob.controller.add_log_message(f"USER RECOGNIZER - - Server error: {e}")
+            return None
+        self.gate.update(thumbnail, reply["payload"])
+        return reply
+
+    def step(self):
+        reply = self._recognize()
+        if reply is None:
+            return
+        payload = reply["payload"]
+        if payload is not None:
+            self.distance = reply["distance"]
+            glob.logged_user = payload
+            glob.logged_user.set_mode(False)
+            glob.controller.rotate_back_seat(glob.logged_user.get_position())
+            return False
 
-    def run(self):
-        while not glob.stop_flag:
-            time.sleep(1 / self._frequency)
-            start_time = time.time()
-            with glob.shared_frame_lock:
-                img = copy.deepcopy(glob.actual_frame)
-            with glob.controller.socket_lock:
-                socket_communication.send({"type": "user-recognition", "frame": img.tobytes()})
-                reply = socket_communication.recv("U")
-            with open("user_recognizer.csv", "a") as f:
-                f.write(str(time.time() - start_time) + "\n")
-            if reply["payload"] is not None:
-                user = pickle.loads(reply["payload"])
-                glob.logged_user = user
-                glob.logged_user.set_mode(False)
-                glob.controller.rotate_back_seat(glob.logged_user.get_position())
-                return
+    def verify(self):
+        reply = self._recognize()
+        if reply is None or reply["payload"] is None:  # no new scene or no registered face in front of the camera
+            return
+        with glob.user_lock:
+            name = glob.logged_user.get_name()
+        if reply["payload"].get_name() != name:
+            glob.controller.add_log_message(f"USER RECOGNIZER - - " + reply["payload"].get_name() +
+                                            " recognized on the seat of " + name)
@@ -0,0 +1,153 @@
+import io
+import time
+import zlib
+
+import numpy as np
+from PIL import Image
+
+import metrics
+
+# Compression modes for the frames sent from the client to the server:
+#   raw:         uncompressed pixels
+#   camera-jpeg: the JPEG produced by the camera, sent as it is (re-encoded if not available)
+#   jpeg:        frame re-encoded as JPEG with the given quality
+#   png:         frame encoded as PNG (lossless)
+#   downscale:   frame downscaled by the given factor and encoded as JPEG, the server scales it back
+#   gray:        grayscale frame encoded as JPEG, the server replicates the channel
+#   delta:       lossless difference w.r.t. the previous frame (zlib), with a full frame every keyframe_interval
+CODECS = ['raw', 'camera-jpeg', 'jpeg', 'png', 'downscale', 'gray', 'delta']
+_CODEC_CODES = {name: code for code, name in enumerate(CODECS)}
+
+_KEYFRAME = b'\x01'
+_DELTAFRAME = b'\x00'
+
+
+def choose_codec(preferred):  # Returns the first codec of the client preferences that is supported
+    for name in preferred:
+        if name in _CODEC_CODES:
+            return name
+    return 'raw'
+
+
+class CodecStats:
+    """
+    Per phase statistics of the frame transport: number of frames, raw and on-the-wire bytes and
+    time spent for encoding/decoding. They are also recorded in the metrics, as the stage (encode or decode)
+    of the side (client or server)
+    """
+
+    def __init__(self, side, stage):
+        self.side = side
+        self.stage = stage
+        self._phases = {}
+
+    def add(self, phase, raw_bytes, wire_bytes, elapsed):
+        metrics.record(self.side, phase, self.stage, elapsed)
+        metrics.count(self.side, phase, "raw_bytes", raw_bytes)
+        metrics.count(self.side, phase, "wire_bytes", wire_bytes)
+        stats = self._phases.setdefault(phase, [0, 0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += raw_bytes
+        stats[2] += wire_bytes
+        stats[3] += elapsed
+
+    def report(self):
+        report = {}
+        for phase, (count, raw_bytes, wire_bytes, elapsed) in self._phases.items():
+            report[phase] = {"frames": count,
+                             "raw_bytes": raw_bytes,
+                             "wire_bytes": wire_bytes,
+                             "ratio": raw_bytes / wire_bytes if wire_bytes > 0 else 0,
+                             "avg_time": elapsed / count}
+        return report
+
+
+class FrameEncoder:
+    def __init__(self, codec='raw', quality=80, scale=0.5, keyframe_interval=30):
+        self.codec = codec
+        self.quality = quality
+        self.scale = scale
+        self.keyframe_interval = keyframe_interval
+        self.stats = CodecStats("client", "encode")
+        self._reference = None
+        self._frames_since_keyframe = 0
+
+    def _to_jpeg(self, img):
+        buffer = io.BytesIO()
+        img.save(buffer, format="jpeg", quality=self.quality)
+        return buffer.getvalue()
+
+    def _delta(self, frame):
+        if self._reference is None or self._reference.shape != frame.shape \
+                or self._frames_since_keyframe >= self.keyframe_interval:
+            self._frames_since_keyframe = 0
+            payload = _KEYFRAME + zlib.compress(frame, 1)
+        else:
+            self._frames_since_keyframe += 1
+            payload = _DELTAFRAME + zlib.compress(np.subtract(frame, self._reference, dtype=np.uint8), 1)
+        self._reference = frame.copy()
+        return payload
+
+    def encode(self, frame, jpeg=None, phase=""):
+        """
+        Encodes the frame with the codec of the encoder. It returns the code of the codec actually used
+        and the payload (the frame itself if the codec is raw)
+        """
+        start_time = time.perf_counter()
+        codec = self.codec
+        if codec == 'camera-jpeg' and jpeg is None:  # no camera JPEG available, re-encode the frame
+            codec = 'jpeg'
+        if codec == 'raw':
+            payload = frame
+        elif codec == 'camera-jpeg':
+            payload = jpeg
+        elif codec == 'jpeg':
+            payload = self._to_jpeg(Image.fromarray(frame))
+        elif codec == 'png':
+            buffer = io.BytesIO()
+            Image.fromarray(frame).save(buffer, format="png", compress_level=1)
+            payload = buffer.getvalue()
+        elif codec == 'downscale':
+            img = Image.fromarray(frame)
+            size = (max(1, int(img.width * self.scale)), max(1, int(img.height * self.scale)))
+            payload = self._to_jpeg(img.resize(size, resample=Image.BILINEAR))
+        elif codec == 'gray':
+            payload = self._to_jpeg(Image.fromarray(frame).convert("L"))
+        else:  # delta
+            payload = self._delta(np.ascontiguousarray(frame))
+        self.stats.add(phase, frame.nbytes, len(payload) if codec != 'raw' else frame.nbytes,
+                       time.perf_counter() - start_time)
+        return _CODEC_CODES[codec], payload
+
+
+class FrameDecoder:
+    def __init__(self):
+        self.stats = CodecStats("server", "decode")
+        self._reference = None
+
+    def decode(self, code, payload, shape, phase=""):
+        """
+        Decodes the payload into a uint8 numpy array with the given shape (the shape of the original frame)
+        """
+        start_time = time.perf_counter()
+        codec = CODECS[code]
+        if codec == 'delta':
+            # decompressed up to the size of the frame, a longer payload fails the reshape
+            size = int(np.prod(shape, dtype=np.int64))
+            frame = np.frombuffer(zlib.decompressobj().decompress(payload[1:], size + 1),
+                                  dtype=np.uint8).reshape(shape)
+            if payload[:1] == _DELTAFRAME:
+                if self._reference is None:
+                    raise ValueError("Delta frame received before a keyframe")
+                frame = np.add(self._reference, frame, dtype=np.uint8)
+            frame.setflags(write=False)  # the frame is also the reference for the next delta
+            self._reference = frame
+        else:
+            img = Image.open(io.BytesIO(payload))
+            if (img.height, img.width) != tuple(shape[:2]):  # downscaled frame
+                img = img.resize((shape[1], shape[0]), resample=Image.BILINEAR)
+            frame = np.array(img)
+            if frame.ndim == 2 and len(shape) == 3:  # grayscale frame, replicate the channel
+                frame = np.repeat(frame[:, :, np.newaxis], shape[2], axis=2)
+        self.stats.add(phase, frame.nbytes, len(payload), time.perf_counter() - start_time)
+        return frame
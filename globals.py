@@ -1,18 +1,16 @@
 import threading
 
+from client.frame_buffer import FrameRingBuffer
 from client.seat_comfort_controller import SeatComfortController
 
-# lock to ensure mutual exclusion for the access of the frame
-shared_frame_lock = threading.Lock()
-actual_frame = None
+# ring buffer with the latest frames captured by the camera (the sequence number of a frame is also its id
+# for the server, used to share the analysis of a frame among requests)
+frame_buffer = FrameRingBuffer()
 
 # actual logged user
 user_lock = threading.Lock()
 logged_user = None
 
-# lock for the seat position
-seat_position_lock = threading.Lock()
-
 # lock for the data
 log_lock = threading.Lock()
 
@@ -0,0 +1,175 @@
+import json
+import threading
+import time
+
+# In-process telemetry shared by client and server. The latencies are keyed by side (client or server),
+# phase (U, N, M, A, see socket_communication.PHASES) and stage of the pipeline:
+#   capture:    the camera produces a frame (client)
+#   encode:     compression of the frame (client)
+#   round-trip: from the send of a request to its reply (client)
+#   network:    round trip minus the time the request spent in the server (client)
+#   decode:     decompression of the frame (server)
+#   inference:  analysis of the request (server)
+#   service:    from the receive of a request to the send of its reply (server)
+# Recording only appends to a buffer of the calling thread (no locks, no I/O): the buffers are merged in the
+# histograms in batches by flush, called periodically by a background thread
+
+
+class Histogram:
+    """
+    HDR-style histogram of latencies in microseconds: log-linear buckets with 2 ** precision sub-buckets for
+    every power of two, so the relative error of the percentiles is below 2 ** -precision
+    """
+
+    def __init__(self, precision=5):
+        self._precision = precision
+        self._sub_buckets = 2 ** precision
+        self._counts = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _index(self, value):
+        if value < self._sub_buckets:
+            return value
+        exponent = value.bit_length() - self._precision - 1
+        return exponent * self._sub_buckets + (value >> exponent)
+
+    def _value(self, index):  # lowest value of the bucket
+        if index < self._sub_buckets:
+            return index
+        exponent = index // self._sub_buckets - 1
+        return (index - exponent * self._sub_buckets) << exponent
+
+    def record(self, value):
+        index = self._index(value)
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percentile):
+        threshold = self.count * percentile / 100
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= threshold:  # middle of the bucket
+                return min((self._value(index) + self._value(index + 1)) // 2, self.max)
+        return self.max
+
+    def summary(self):  # count and latencies in milliseconds
+        return {"count": self.count,
+                "mean": self.total / self.count / 1000 if self.count > 0 else 0,
+                "p50": self.percentile(50) / 1000,
+                "p90": self.percentile(90) / 1000,
+                "p99": self.percentile(99) / 1000,
+                "max": self.max / 1000}
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._local = threading.local()
+        self._buffers = []  # (thread, buffer) of the threads that recorded something
+        self._lock = threading.Lock()  # protects the list of buffers and the aggregated metrics
+        self._histograms = {}  # "side/phase/stage" -> Histogram
+        self._counters = {}  # "side/phase/name" -> value
+        self._flusher = None
+        self._stop = threading.Event()
+
+    def _buffer(self):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = []
+            with self._lock:
+                self._buffers.append((threading.current_thread(), buffer))
+        return buffer
+
+    def record(self, side, phase, stage, seconds):  # Records a latency of the stage
+        self._buffer().append((True, side + "/" + (phase or "-") + "/" + stage, int(seconds * 1e6)))
+
+    def count(self, side, phase, name, value=1):  # Increments a counter (e.g. bytes sent)
+        self._buffer().append((False, side + "/" + (phase or "-") + "/" + name, value))
+
+    def flush(self):  # Merges the buffers of the threads in the histograms and counters
+        with self._lock:
+            for thread, buffer in self._buffers:
+                # the owner thread only appends: the samples taken so far are removed in one step
+                samples = buffer[:]
+                del buffer[:len(samples)]
+                for is_latency, key, value in samples:
+                    if is_latency:
+                        if key not in self._histograms:
+                            self._histograms[key] = Histogram()
+                        self._histograms[key].record(value)
+                    else:
+                        self._counters[key] = self._counters.get(key, 0) + value
+            # forget the buffers of the terminated threads (e.g. the ones of the closed connections)
+            self._buffers = [(thread, buffer) for thread, buffer in self._buffers
+                             if thread.is_alive() or len(buffer) > 0]
+
+    def snapshot(self):  # Percentiles of the latencies (in milliseconds) and counters
+        self.flush()
+        with self._lock:
+            return {"time": time.time(),
+                    "latency": {key: histogram.summary() for key, histogram in sorted(self._histograms.items())},
+                    "counters": dict(sorted(self._counters.items()))}
+
+    def report(self):
+        snapshot = self.snapshot()
+        lines = [f"{'latency (ms)':<28}{'count':>8}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}"]
+        for key, stats in snapshot["latency"].items():
+            lines.append(f"{key:<28}{stats['count']:>8}{stats['mean']:>9.2f}{stats['p50']:>9.2f}"
+                         f"{stats['p90']:>9.2f}{stats['p99']:>9.2f}{stats['max']:>9.2f}")
+        for key, value in snapshot["counters"].items():
+            lines.append(f"{key:<28}{value:>8}")
+        return "\n".join(lines)
+
+    def start(self, interval=1.0, path=None, export_interval=60.0):
+        """
+        Starts the background thread that flushes the buffers every interval seconds and, if a path is given,
+        appends a snapshot (a JSON line) to it every export_interval seconds
+        """
+        self._stop.clear()
+        self._flusher = threading.Thread(target=self._flush_loop, args=(interval, path, export_interval),
+                                         daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self, interval, path, export_interval):
+        next_export = time.monotonic() + export_interval
+        while not self._stop.wait(interval):
+            self.flush()
+            if path is not None and time.monotonic() >= next_export:
+                next_export += export_interval
+                self.export(path)
+
+    def export(self, path):
+        with open(path, "a") as f:
+            f.write(json.dumps(self.snapshot()) + "\n")
+
+    def stop(self, path=None):  # Stops the background thread, exporting a last snapshot if a path is given
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        if path is not None:
+            self.export(path)
+
+
+# Registry of the process, used by the module level functions
+registry = MetricsRegistry()
+
+
+def record(side, phase, stage, seconds):
+    registry.record(side, phase, stage, seconds)
+
+
+def count(side, phase, name, value=1):
+    registry.count(side, phase, name, value)
+
+
+def snapshot():
+    return registry.snapshot()
+
+
+def report():
+    return registry.report()
@@ -0,0 +1,80 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class EyesBatchScheduler:
+    """
+    Micro-batching of the eye state inference. The features of the eyes are extracted by the calling worker
+    thread, then the eyes of all the need-detection frames (of any connection) that arrive within a small
+    time window are classified by the scheduler thread with a single predict call
+    """
+
+    def __init__(self, eyes_detection, window=0.01, max_batch=64):
+        self.eyes_detection = eyes_detection
+        self.window = window  # Seconds to wait for other frames after the first one of a batch
+        self.max_batch = max_batch  # Maximum number of eyes in a batch
+        self._queue = queue.Queue()
+        self._batches = 0
+        self._frames = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def classify_eyes(self, img, tracker=None):
+        # Returns 1 if the eyes are closed, 0 if they are opened, -1 if there are no faces
+        return self._classify(self.eyes_detection.get_eyes_inputs(img, tracker))
+
+    def classify_face_crops(self, face_imgs):
+        # Same as classify_eyes, for faces already detected (see EyesDetection.get_face_crop)
+        return self._classify(self.eyes_detection.get_face_crops_inputs(face_imgs))
+
+    def _classify(self, inputs):
+        if inputs is None:
+            return -1
+        future = Future()
+        self._queue.put((inputs, future))
+        return self.eyes_detection.get_eyes_state(future.result())
+
+    def warm_up(self, img):
+        self.eyes_detection.warm_up(img)
+
+    def _next_batch(self):
+        # wait for the first frame, then collect the other ones arrived within the window
+        pending = [self._queue.get()]
+        num_eyes = len(pending[0][0][0])
+        deadline = time.time() + self.window
+        while num_eyes < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+            num_eyes += len(pending[-1][0][0])
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._next_batch()
+            inputs = [np.concatenate([frame_inputs[k] for frame_inputs, _ in pending]) for k in range(4)]
+            try:
+                predictions = self.eyes_detection.predict_eyes(inputs)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            # split the predictions among the frames of the batch
+            offset = 0
+            for frame_inputs, future in pending:
+                future.set_result(predictions[offset:offset + len(frame_inputs[0])])
+                offset += len(frame_inputs[0])
+            self._batches += 1
+            self._frames += len(pending)
+
+    def report(self):
+        return {"batches": self._batches,
+                "frames": self._frames,
+                "avg_batch": self._frames / self._batches if self._batches > 0 else 0}
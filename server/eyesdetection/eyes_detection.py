@@ -1,5 +1,4 @@
 #  Code taken from 'https://github.com/ymitiku/EyeStateDetection' and slightly adjusted
-import copy
 import os
 
 import cv2
@@ -9,13 +8,19 @@ from keras.models import model_from_json
 
 
 class EyesDetection:
+    # Indexes of the eleven dlib key points (eyebrow and eye) of the left and right eye
+    EYES_KEY_POINTS = np.array([list(range(22, 27)) + list(range(42, 48)),
+                                list(range(17, 22)) + list(range(36, 42))])
+
     def __init__(self):
-        self.json_path = "eyesdetection/models/model.json"
-        self.weights_path = "eyesdetection/models/model.h5"
+        # paths relative to this module, so that they do not depend on the working directory
+        module_dir = os.path.dirname(os.path.abspath(__file__))
+        self.json_path = os.path.join(module_dir, "models/model.json")
+        self.weights_path = os.path.join(module_dir, "models/model.h5")
 
         self.model = self.load_model(self.json_path, self.weights_path)
         self.detector = dlib.get_frontal_face_detector()
-        self.predictor = dlib.shape_predictor("eyesdetection/shape_predictor_68_face_landmarks.dat")
+        self.predictor = dlib.shape_predictor(os.path.join(module_dir, "shape_predictor_68_face_landmarks.dat"))
 
     def load_model(self, json_path, weights_path):
         """ Loads keras model
@@ -38,152 +43,133 @@ class EyesDetection:
             model.load_weights(weights_path)
             return model
 
+    def warm_up(self, img):
+        """Runs the model on dummy eyes (a dummy frame has no faces, so the model would not be used)
+        and the whole classification on the image.
+        Parameters
+        ----------
+        img : numpy.ndarray
+            Dummy frame
+        """
+        self.model.predict([np.zeros((2, 24, 24, 1), dtype=np.float32), np.zeros((2, 1, 11, 2), dtype=np.float32),
+                            np.zeros((2, 1, 11, 1), dtype=np.float32), np.zeros((2, 1, 11, 1), dtype=np.float32)],
+                           verbose=0)
+        self.classify_eyes(img)
+
     def distance_between(self, v1, v2):
-        """Calculates euclidean distance between two vectors.
-        If one of the arguments is matrix then the output is calculated for each row
-        of that matrix.
+        """Calculates euclidean distance between point vectors along the last axis.
+        Arguments are broadcast, so the distances of a batch of eyes can be computed in one call.
 
         Parameters
         ----------
         v1 : numpy.ndarray
-            First vector
+            First vectors
         v2 : numpy.ndarray
-            Second vector
+            Second vectors
 
         Returns:
         --------
         numpy.ndarray
-            Matrix if one of the arguments is matrix and vector if both arguments are vectors.
+            Distances, with the shape of the broadcast arguments without the last axis.
         """
 
         diff = v2 - v1
         diff_squared = np.square(diff)
-        dist_squared = diff_squared.sum(axis=1)
+        dist_squared = diff_squared.sum(axis=-1)
         dists = np.sqrt(dist_squared)
         return dists
 
     def angles_between(self, v1, v2):
-        """Calculates angle between two point vectors.
+        """Calculates angle between point vectors along the last axis.
         Parameters
         ----------
         v1 : numpy.ndarray
-            First vector
+            First vectors
         v2 : numpy.ndarray
-            Second vector
+            Second vectors
 
         Returns:
         --------
         numpy.ndarray
-            Vector if one of the arguments is matrix and scalar if both arguments are vectors.
+            Angles, with the shape of the broadcast arguments without the last axis.
         """
-        dot_prod = (v1 * v2).sum(axis=1)
-        v1_norm = np.linalg.norm(v1, axis=1)
-        v2_norm = np.linalg.norm(v2, axis=1)
+        dot_prod = (v1 * v2).sum(axis=-1)
+        v1_norm = np.linalg.norm(v1, axis=-1)
+        v2_norm = np.linalg.norm(v2, axis=-1)
 
-        cosine_of_angle = (dot_prod / (v1_norm * v2_norm)).reshape(11, 1)
+        cosine_of_angle = dot_prod / (v1_norm * v2_norm)
 
         angles = np.arccos(np.clip(cosine_of_angle, -1, 1))
 
         return angles
 
     def get_attributes_wrt_local_frame(self, face_image, key_points_11, image_shape):
-        """Extracts eye image, key points of the eye region with respect
-        face eye image, angles and distances between centroid of key point of eye  and
-        other key points of the eye.
+        """Extracts eye images, key points of the eye regions with respect
+        eye images, angles and distances between centroid of key points of each eye and
+        other key points of the eye. All the eyes are processed together.
         Parameters
         ----------
         face_image : numpy.ndarray
             Image of the face
         key_points_11 : numpy.ndarray
-            Eleven key points of the eye including eyebrow region.
+            Eleven key points of each eye including eyebrow region, shape (eyes, 11, 2).
         image_shape : tuple
-            Shape of the output eye image
+            Shape of the output eye images
 
         Returns
         -------
-        eye_image : numpy.ndarray
-            Image of the eye region
+        eye_images : numpy.ndarray
+            Images of the eye regions
         key_points_11 : numpy.ndarray
-            Eleven key points translated to eye image frame
+            Eleven key points of each eye translated to eye image frame
         dists : numpy.ndarray
-            Distances of each 11 key points from centeroid of all 11 key points
+            Distances of each 11 key points from centeroid of all 11 key points of the eye
         angles : numpy.ndarray
-            Angles between each 11 key points from centeroid
+            Angles between each 11 key points from centeroid of the eye
 
         """
 
         face_image_shape = face_image.shape
-        top_left = key_points_11.min(axis=0)
-        bottom_right = key_points_11.max(axis=0)
+        top_left = key_points_11.min(axis=1)
+        bottom_right = key_points_11.max(axis=1)
 
         # bound the coordinate system inside eye image
-        bottom_right[0] = min(face_image_shape[1], bottom_right[0])
-        bottom_right[1] = min(face_image_shape[0], bottom_right[1] + 5)
-        top_left[0] = max(0, top_left[0])
-        top_left[1] = max(0, top_left[1])
+        bottom_right[:, 0] = np.minimum(face_image_shape[1], bottom_right[:, 0])
+        bottom_right[:, 1] = np.minimum(face_image_shape[0], bottom_right[:, 1] + 5)
+        top_left = np.maximum(0, top_left)
 
-        # crop the eye
         top_left = top_left.astype(np.uint8)
         bottom_right = bottom_right.astype(np.uint8)
-        eye_image = face_image[top_left[1]:bottom_right[1], top_left[0]:bottom_right[0]]
+        eye_images = np.empty((len(key_points_11), image_shape[1], image_shape[0]), dtype=face_image.dtype)
+        scale = np.empty((len(key_points_11), 1, 2))
+        for i in range(len(key_points_11)):
+            # crop the eye and resize it to network input size
+            eye_image = face_image[top_left[i, 1]:bottom_right[i, 1], top_left[i, 0]:bottom_right[i, 0]]
+            # horizontal and vertical scale to resize image
+            scale[i, 0] = (image_shape[1] / float(eye_image.shape[1]), image_shape[0] / float(eye_image.shape[0]))
+            eye_images[i] = cv2.resize(eye_image, (image_shape[0], image_shape[1]))
+
         # translate the eye key points from face image frame to eye image frame
-        key_points_11 = key_points_11 - top_left
+        key_points_11 = key_points_11 - top_left[:, np.newaxis, :]
         key_points_11 += np.finfo(float).eps
-        # horizontal scale to resize image
-        scale_h = image_shape[1] / float(eye_image.shape[1])
-        # vertical scale to resize image
-        scale_v = image_shape[0] / float(eye_image.shape[0])
-
-        # resize left eye image to network input size
-        eye_image = cv2.resize(eye_image, (image_shape[0], image_shape[1]))
 
-        # scale left key points proportional with respect to left eye image resize scale
-        scale = np.array([[scale_h, scale_v]])
+        # scale key points proportional with respect to eye image resize scale
         key_points_11 = key_points_11 * scale
 
-        # calculate centroid of left eye key points
-        centroid = np.array([key_points_11.mean(axis=0)])
+        # calculate centroid of the key points of each eye
+        centroids = key_points_11.mean(axis=1, keepdims=True)
 
-        # calculate distances from  centroid to each left eye key points
-        dists = self.distance_between(key_points_11, centroid)
+        # calculate distances from centroid to each key point of the eye
+        dists = self.distance_between(key_points_11, centroids)
 
-        # calculate angles between centroid point vector and left eye key points vectors
-        angles = self.angles_between(key_points_11, centroid)
-        return eye_image, key_points_11, dists, angles
-
-    def get_right_key_points(self, key_points):
-        """Extract dlib key points from right eye region including eye brow region.
-        Parameters
-        ----------
-        key_points : numpy.ndarray
-            Dlib face key points
-        Returns:
-            dlib key points of right eye region
-        """
-
-        output = np.zeros((11, 2))
-        output[0:5] = key_points[17:22]
-        output[5:11] = key_points[36:42]
-        return output
-
-    def get_left_key_points(self, key_points):
-        """Extract dlib key points from left eye region including eye brow region.
-        Parameters
-        ----------
-        key_points : numpy.ndarray
-            Dlib face key points
-        Returns:
-            dlib key points of left eye region
-        """
-        output = np.zeros((11, 2))
-        output[0:5] = key_points[22:27]
-        output[5:11] = key_points[42:48]
-        return output
+        # calculate angles between centroid point vector and key points vectors of the eye
+        angles = self.angles_between(key_points_11, centroids)
+        return eye_images, key_points_11, dists, angles
 
-    def get_left_eye_attributes(self, face_image, predictor, image_shape):
+    def get_eyes_attributes(self, face_image, predictor, image_shape):
         """Extracts eye image, key points, distance of each key points
         from centroid of the key points and angles between centroid and
-        each key points of left eye.
+        each key points of both the eyes, with a single pass of the shape predictor.
 
         Parameters
         ----------
@@ -195,66 +181,24 @@ class EyesDetection:
             The output eye image shape
         Returns
         -------
-        eye_image : numpy.ndarray
-            Image of the eye region
+        eye_images : numpy.ndarray
+            Images of the left and right eye regions
         key_points_11 : numpy.ndarray
-            Eleven key points translated to eye image frame
+            Eleven key points of each eye translated to eye image frame
         dists : numpy.ndarray
-            Distances of each 11 key points from centeroid of all 11 key points
+            Distances of each 11 key points from centeroid of all 11 key points of the eye
         angles : numpy.ndarray
-            Angles between each 11 key points from centeroid
+            Angles between each 11 key points from centeroid of the eye
 
         """
 
         face_image_shape = face_image.shape
         face_rect = dlib.rectangle(0, 0, face_image_shape[1], face_image_shape[0])
         kps = self.get_dlib_points(face_image, predictor, face_rect)
-        # Get key points of the eye and eyebrow
+        # Get key points of the eyes and eyebrows (left and right eye)
+        key_points_11 = kps[EyesDetection.EYES_KEY_POINTS]
 
-        key_points_11 = self.get_left_key_points(kps)
-
-        eye_image, key_points_11, dists, angles = self.get_attributes_wrt_local_frame(face_image, key_points_11,
-                                                                                      image_shape)
-
-        return eye_image, key_points_11, dists, angles
-
-    def get_right_eye_attributes(self, face_image, predictor, image_shape):
-        """Extracts eye image, key points, distance of each key points
-        from centroid of the key points and angles between centroid and
-        each key points of right eye.
-
-        Parameters
-        ----------
-        face_image : numpy.ndarray
-            Image of the face
-        predictor : dlib.shape_predictor
-            Dlib Shape predictor to extract key points
-        image_shape : tuple
-            The output eye image shape
-        Returns
-        -------
-        eye_image : numpy.ndarray
-            Image of the eye region
-        key_points_11 : numpy.ndarray
-            Eleven key points translated to eye image frame
-        dists : numpy.ndarray
-            Distances of each 11 key points from centeroid of all 11 key points
-        angles : numpy.ndarray
-            Angles between each 11 key points from centeroid
-
-        """
-
-        face_image_shape = face_image.shape
-        face_rect = dlib.rectangle(0, 0, face_image_shape[1], face_image_shape[0])
-        kps = self.get_dlib_points(face_image, predictor, face_rect)
-        # Get key points of the eye and eyebrow
-
-        key_points_11 = self.get_right_key_points(kps)
-
-        eye_image, key_points_11, dists, angles = self.get_attributes_wrt_local_frame(face_image, key_points_11,
-                                                                                      image_shape)
-
-        return eye_image, key_points_11, dists, angles
+        return self.get_attributes_wrt_local_frame(face_image, key_points_11, image_shape)
 
     def get_dlib_points(self, img, predictor, rectangle):
         """Extracts dlib key points from face image
@@ -273,53 +217,98 @@ class EyesDetection:
         """
 
         shape = predictor(img, rectangle)
-        dlib_points = np.zeros((68, 2))
-        for i, part in enumerate(shape.parts()):
-            dlib_points[i] = [part.x, part.y]
-        return dlib_points
+        return np.array([(part.x, part.y) for part in shape.parts()], dtype=np.float64)
 
-    def classify_eyes(self, img):
-        img = copy.deepcopy((img))
+    def get_face_crop(self, gray, face):
+        """Crops the face from the grayscale frame and resizes it to the size used for the key points.
+        Parameters
+        ----------
+        gray : numpy.ndarray
+            Grayscale frame
+        face : dlib.rectangle
+            Face bounding box inside the frame
+        Returns
+        -------
+        numpy.ndarray
+            Grayscale 100x100 image of the face
+        """
+        face_img = gray[
+                   max(0, face.top()):min(gray.shape[0], face.bottom()),
+                   max(0, face.left()):min(gray.shape[1], face.right())
+                   ]
+        return cv2.resize(face_img, (100, 100))
+
+    def get_eyes_inputs(self, img, tracker=None):
+        """Extracts the inputs of the model for both the eyes of every face in the image, stacked in a
+        single batch (left and right eye of the first face, then left and right eye of the second one...).
+        The frame is only read, it is not copied.
+        Parameters
+        ----------
+        img : numpy.ndarray
+            Frame
+        tracker : FaceTracker
+            Tracker of the face of the seat, if given the faces are searched through it
+        Returns
+        -------
+        list
+            Eye images, key points, distances and angles of all the eyes, None if there are no faces
+        """
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces = self.detector(gray)
-        for i, face in enumerate(faces):
-            face_img = gray[
-                       max(0, face.top()):min(gray.shape[0], face.bottom()),
-                       max(0, face.left()):min(gray.shape[1], face.right())
-                       ]
-            cv2.rectangle(img, (face.left(), face.top()), (face.right(), face.bottom()), color=(255, 0, 0),
-                          thickness=2)
-            face_img = cv2.resize(face_img, (100, 100))
-            l_i, lkp, ld, la = self.get_left_eye_attributes(face_img, self.predictor, (24, 24, 1))
-            r_i, rkp, rd, ra = self.get_right_eye_attributes(face_img, self.predictor, (24, 24, 1))
-
-            l_i = l_i.reshape(-1, 24, 24, 1).astype(np.float32) / 255
-            r_i = r_i.reshape(-1, 24, 24, 1).astype(np.float32) / 255
-
-            lkp = np.expand_dims(lkp, 1).astype(np.float32) / 24
-            ld = np.expand_dims(ld, 1).astype(np.float32) / 24
-            la = np.expand_dims(la, 1).astype(np.float32) / np.pi
-
-            rkp = np.expand_dims(rkp, 1).astype(np.float32) / 24
-            rd = np.expand_dims(rd, 1).astype(np.float32) / 24
-            ra = np.expand_dims(ra, 1).astype(np.float32) / np.pi
-
-            lkp = lkp.reshape(-1, 1, 11, 2)
-            ld = ld.reshape(-1, 1, 11, 1)
-            la = la.reshape(-1, 1, 11, 1)
-
-            rkp = rkp.reshape(-1, 1, 11, 2)
-            rd = rd.reshape(-1, 1, 11, 1)
-            ra = ra.reshape(-1, 1, 11, 1)
-
-            left_prediction = self.model.predict([l_i, lkp, ld, la], verbose=0)[0]
-            right_prediction = self.model.predict([r_i, rkp, rd, ra], verbose=0)[0]
-
-            left_arg_max = np.argmax(left_prediction)
-            right_arg_max = np.argmax(right_prediction)
-
-            if left_arg_max == 0 and right_arg_max == 0:  # Both eyes are closed
-                return 1
-            else:  # Both eyes are opened
-                return 0
-        return -1
+        faces = self.detector(gray) if tracker is None else tracker.detect(gray, self.detector)
+        return self.get_face_crops_inputs([self.get_face_crop(gray, face) for face in faces])
+
+    def get_face_crops_inputs(self, face_imgs):
+        """Extracts the inputs of the model for both the eyes of already detected faces (see get_eyes_inputs).
+        Parameters
+        ----------
+        face_imgs : list
+            Grayscale 100x100 images of the faces (see get_face_crop)
+        Returns
+        -------
+        list
+            Eye images, key points, distances and angles of all the eyes, None if there are no faces
+        """
+        if len(face_imgs) == 0:
+            return None
+        eyes = [self.get_eyes_attributes(face_img, self.predictor, (24, 24, 1)) for face_img in face_imgs]
+
+        eye_images = np.concatenate([eye[0] for eye in eyes]).reshape(-1, 24, 24, 1).astype(np.float32) / 255
+        key_points = np.concatenate([eye[1] for eye in eyes]).reshape(-1, 1, 11, 2).astype(np.float32) / 24
+        dists = np.concatenate([eye[2] for eye in eyes]).reshape(-1, 1, 11, 1).astype(np.float32) / 24
+        angles = np.concatenate([eye[3] for eye in eyes]).reshape(-1, 1, 11, 1).astype(np.float32) / np.pi
+        return [eye_images, key_points, dists, angles]
+
+    def predict_eyes(self, inputs):
+        """Runs the model on a batch of eyes with a single predict call.
+        Parameters
+        ----------
+        inputs : list
+            Eye images, key points, distances and angles of the eyes (see get_eyes_inputs)
+        Returns
+        -------
+        numpy.ndarray
+            Prediction for each eye
+        """
+        return self.model.predict(inputs, verbose=0)
+
+    def get_eyes_state(self, predictions):
+        """Returns the state of the eyes of the first face: 1 if both the eyes are closed, 0 otherwise.
+        Parameters
+        ----------
+        predictions : numpy.ndarray
+            Predictions of the eyes of the frame (see predict_eyes)
+        """
+        left_arg_max = np.argmax(predictions[0])
+        right_arg_max = np.argmax(predictions[1])
+
+        if left_arg_max == 0 and right_arg_max == 0:  # Both eyes are closed
+            return 1
+        else:  # Both eyes are opened
+            return 0
+
+    def classify_eyes(self, img, tracker=None):
+        # Returns 1 if the eyes are closed, 0 if they are opened, -1 if there are no faces
+        inputs = self.get_eyes_inputs(img, tracker)
+        if inputs is None:
+            return -1
+        return self.get_eyes_state(self.predict_eyes(inputs))
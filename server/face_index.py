@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+
+class FaceIndex:
+    """
+    Persistent index of the face embeddings of the registered users. The embeddings are L2 normalized and
+    appended to a float32 matrix on disk (memory mapped when loaded), the names of the users are stored one
+    per line in the same order. A user can have several embeddings (at most max_per_user), a query is a single
+    matrix-vector product (cosine distance) over all the rows
+    """
+
+    def __init__(self, index_dir, threshold=0.40, max_per_user=10):
+        self._index_dir = index_dir
+        self._embeddings_path = os.path.join(index_dir, "embeddings.f32")
+        self._names_path = os.path.join(index_dir, "names.txt")
+        self._info_path = os.path.join(index_dir, "index.json")
+        self.threshold = threshold  # Maximum cosine distance for a match
+        self.max_per_user = max_per_user  # Budget of embeddings of a user
+        self._lock = threading.Lock()  # Lock for the updates of the index
+        self._dim = None
+        self._names = []
+        self._counts = {}  # name -> number of embeddings of the user
+        self._embeddings = None
+        os.makedirs(index_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._info_path):
+            return
+        with open(self._info_path, "r") as f:
+            self._dim = json.load(f)["dim"]
+        with open(self._names_path, "r") as f:
+            names = f.read().splitlines()
+        # an interrupted update leaves a row without the name (or a partial row): both files are cut to the
+        # complete rows, so the next rows are appended aligned
+        row_size = 4 * self._dim
+        embeddings_size = os.path.getsize(self._embeddings_path) if os.path.exists(self._embeddings_path) else 0
+        rows = min(len(names), embeddings_size // row_size)
+        if embeddings_size != rows * row_size:
+            with open(self._embeddings_path, "r+b") as f:
+                f.truncate(rows * row_size)
+        if len(names) != rows:
+            with open(self._names_path, "w") as f:
+                f.writelines(name + "\n" for name in names[:rows])
+        self._names = names[:rows]
+        for name in self._names:
+            self._counts[name] = self._counts.get(name, 0) + 1
+        if rows > 0:
+            self._embeddings = np.memmap(self._embeddings_path, dtype=np.float32, mode='r', shape=(rows, self._dim))
+
+    def __len__(self):
+        return len(self._names)
+
+    def count(self, name):  # Number of embeddings of the user
+        return self._counts.get(name, 0)
+
+    def add(self, name, embedding):
+        """
+        Adds the embedding of the user to the index, appending it to the files (no rebuild of the index).
+        Returns False, without adding it, if the user has already max_per_user embeddings
+        """
+        embedding = np.asarray(embedding, dtype=np.float32)
+        embedding = embedding / np.linalg.norm(embedding)
+        with self._lock:
+            if self.count(name) >= self.max_per_user:
+                return False
+            if self._dim is None:
+                self._dim = embedding.shape[0]
+                with open(self._info_path, "w") as f:
+                    json.dump({"dim": self._dim}, f)
+                open(self._names_path, "w").close()
+            elif embedding.shape[0] != self._dim:
+                raise ValueError("Embedding of size " + str(embedding.shape[0]) + ", expected " + str(self._dim))
+            with open(self._embeddings_path, "ab") as f:
+                f.write(embedding.tobytes())
+            with open(self._names_path, "a") as f:
+                f.write(name + "\n")
+            names = self._names + [name]
+            self._embeddings = np.memmap(self._embeddings_path, dtype=np.float32, mode='r',
+                                         shape=(len(names), self._dim))
+            self._names = names
+            self._counts[name] = self.count(name) + 1
+        return True
+
+    def search(self, embedding):
+        """
+        Returns the name of the nearest user and its cosine distance, the name is None if the index is empty
+        or the distance is above the threshold
+        """
+        embeddings, names = self._embeddings, self._names
+        if len(names) == 0:
+            return None, None
+        embedding = np.asarray(embedding, dtype=np.float32)
+        distances = 1 - embeddings[:len(names)] @ (embedding / np.linalg.norm(embedding))
+        nearest = int(np.argmin(distances))
+        distance = float(distances[nearest])
+        if distance > self.threshold:
+            return None, distance
+        return names[nearest], distance
@@ -0,0 +1,114 @@
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from server.face_tracker import FaceTracker
+
+
+class PreprocessedFrame:
+    """
+    Faces found in a frame, shared by all the analyzers (eyes, mood and user recognition) so that the face
+    detection is done once per frame. The crops needed by each analyzer are computed on first use
+    """
+
+    def __init__(self, frame, gray, faces, eyes_detection):
+        self.frame = frame
+        self.gray = gray
+        self.faces = faces
+        self._eyes_detection = eyes_detection
+        self._face_crops = None
+        self._aligned_face = None
+
+    def face_crops(self):  # Grayscale crops of all the faces for the eyes detection
+        if self._face_crops is None:
+            self._face_crops = [self._eyes_detection.get_face_crop(self.gray, face) for face in self.faces]
+        return self._face_crops
+
+    def aligned_face(self, size=224, margin=0.2):
+        """
+        Returns the RGB crop of the first face, rotated so that the eyes are horizontal, None if there are
+        no faces. It is used for the emotion and the identity of the passenger
+        """
+        if len(self.faces) == 0:
+            return None
+        if self._aligned_face is None:
+            face = self.faces[0]
+            shape = self._eyes_detection.predictor(self.gray, face)
+            points = np.array([(part.x, part.y) for part in shape.parts()], dtype=np.float64)
+            left_eye = points[36:42].mean(axis=0)
+            right_eye = points[42:48].mean(axis=0)
+            angle = np.degrees(np.arctan2(right_eye[1] - left_eye[1], right_eye[0] - left_eye[0]))
+            eyes_center = (left_eye + right_eye) / 2
+            rotation = cv2.getRotationMatrix2D((float(eyes_center[0]), float(eyes_center[1])), float(angle), 1.0)
+            # move the center of the (rotated) face box to the center of the crop
+            side = int(max(face.width(), face.height()) * (1 + margin))
+            face_center = rotation @ np.array([face.center().x, face.center().y, 1.0])
+            rotation[:, 2] += side / 2 - face_center
+            crop = cv2.warpAffine(self.frame, rotation, (side, side))
+            self._aligned_face = cv2.resize(crop, (size, size))
+        return self._aligned_face
+
+    def face_descriptor(self, size=32):
+        """
+        Cheap descriptor of the first face: its aligned grayscale thumbnail, zero mean and unit norm (the dot product
+        of two descriptors is their correlation). None if there are no faces
+        """
+        face = self.aligned_face()
+        if face is None:
+            return None
+        thumbnail = cv2.resize(cv2.cvtColor(face, cv2.COLOR_RGB2GRAY), (size, size), interpolation=cv2.INTER_AREA)
+        descriptor = thumbnail.astype(np.float32).ravel()
+        descriptor -= descriptor.mean()
+        return descriptor / max(float(np.linalg.norm(descriptor)), 1e-6)
+
+    def sharpness(self):  # Variance of the Laplacian of the first face (higher is sharper), None if no faces
+        if len(self.faces) == 0:
+            return None
+        face = self.faces[0]
+        crop = self.gray[max(0, face.top()):face.bottom(), max(0, face.left()):face.right()]
+        return float(cv2.Laplacian(crop, cv2.CV_64F).var())
+
+
+def preprocess_frame(frame, eyes_detection, tracker=None):
+    """
+    Detects the faces of the frame (through the tracker if given) with the detector of the eyes detection
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    detector = eyes_detection.detector
+    faces = detector(gray) if tracker is None else tracker.detect(gray, detector)
+    return PreprocessedFrame(frame, gray, faces, eyes_detection)
+
+
+class FacePreprocessor:
+    """
+    Face detection stage of a client (seat): the faces are tracked between the frames and the preprocessed
+    frames are cached by frame id, so that requests of different types on the same frame share them
+    """
+
+    def __init__(self, cache_size=8):
+        self.face_tracker = FaceTracker()
+        self._cache = OrderedDict()  # frame id -> PreprocessedFrame, in order of use
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def process(self, frame, frame_id, eyes_detection):
+        with self._lock:
+            if frame_id is not None and frame_id in self._cache:
+                self._cache.move_to_end(frame_id)
+                self._hits += 1
+                return self._cache[frame_id]
+            self._misses += 1
+            preprocessed = preprocess_frame(frame, eyes_detection, self.face_tracker)
+            if frame_id is not None:
+                self._cache[frame_id] = preprocessed
+                if len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+            return preprocessed
+
+    def report(self):
+        return {"tracking": self.face_tracker.report(),
+                "frame_cache": {"hits": self._hits, "misses": self._misses}}
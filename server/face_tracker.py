@@ -0,0 +1,58 @@
+import threading
+import time
+
+import dlib
+
+
+class FaceTracker:
+    """
+    Tracks the face of the passenger of a seat between frames. The face detector runs on the full frame only
+    on keyframes, in the other frames it only searches a padded region of interest around the last face box.
+    If the face is not found there (track lost) the full frame detection is done again
+    """
+
+    def __init__(self, keyframe_interval=10, padding=0.5):
+        self.keyframe_interval = keyframe_interval  # Frames between two full frame detections
+        self.padding = padding  # Padding of the region of interest, w.r.t. the size of the last face box
+        self._last_face = None
+        self._frames_since_keyframe = 0
+        self._lock = threading.Lock()  # requests of the same seat can be processed concurrently
+        # number of frames and total time of full detections, tracked frames and lost tracks
+        self._stats = {"detection": [0, 0.0], "track": [0, 0.0], "lost": [0, 0.0]}
+
+    def _search_roi(self, gray, detector):
+        face = self._last_face
+        pad_x = int(face.width() * self.padding)
+        pad_y = int(face.height() * self.padding)
+        left, top = max(0, face.left() - pad_x), max(0, face.top() - pad_y)
+        right, bottom = min(gray.shape[1], face.right() + pad_x), min(gray.shape[0], face.bottom() + pad_y)
+        faces = detector(gray[top:bottom, left:right])
+        # faces in the coordinates of the frame
+        return [dlib.rectangle(f.left() + left, f.top() + top, f.right() + left, f.bottom() + top) for f in faces]
+
+    def detect(self, gray, detector):
+        """
+        Returns the faces in the grayscale frame (only the tracked one between keyframes)
+        """
+        with self._lock:
+            start_time = time.time()
+            mode = "detection"
+            faces = []
+            if self._last_face is not None and self._frames_since_keyframe < self.keyframe_interval:
+                faces = self._search_roi(gray, detector)
+                mode = "track" if len(faces) > 0 else "lost"
+            if len(faces) == 0:  # keyframe, no face tracked or track lost
+                faces = detector(gray)
+                self._frames_since_keyframe = 0
+            else:
+                self._frames_since_keyframe += 1
+            self._last_face = faces[0] if len(faces) > 0 else None
+            self._stats[mode][0] += 1
+            self._stats[mode][1] += time.time() - start_time
+            return faces
+
+    def report(self):
+        frames = sum(count for count, _ in self._stats.values())
+        return {mode: {"rate": count / frames if frames > 0 else 0,
+                       "avg_time": elapsed / count if count > 0 else 0}
+                for mode, (count, elapsed) in self._stats.items()}
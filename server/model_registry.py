@@ -0,0 +1,80 @@
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+
+
+def _rss_bytes():  # Resident memory of the process
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:  # not Linux, use the peak resident memory
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ModelRegistry:
+    """
+    Registry of the models used by the server. All the models are loaded once at startup and warmed up with
+    an inference on a dummy frame, so that the first requests of the clients do not pay the loading and graph
+    building costs. For each model it keeps the load time, the warm-up time and the memory footprint
+    """
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+
+    def __init__(self, frame_shape=(540, 432, 3)):
+        self._frame_shape = frame_shape
+        self._loaders = []  # (name, loader, warmup) in order of registration
+        self._models = {}
+        self._stats = {}
+        self._ready = threading.Event()
+        self.state = ModelRegistry.LOADING
+        self.error = None
+
+    def register(self, name, loader, warmup=None):
+        """
+        Registers a model: loader() returns the model, warmup(model, frame) runs an inference with it
+        """
+        self._loaders.append((name, loader, warmup))
+
+    def load_all(self):
+        dummy_frame = np.zeros(self._frame_shape, dtype=np.uint8)
+        try:
+            for name, loader, warmup in self._loaders:
+                memory = _rss_bytes()
+                start_time = time.time()
+                self._models[name] = loader()
+                load_time = time.time() - start_time
+                start_time = time.time()
+                if warmup is not None:
+                    warmup(self._models[name], dummy_frame)
+                warmup_time = time.time() - start_time
+                self._stats[name] = {"load_time": load_time,
+                                     "warmup_time": warmup_time,
+                                     "memory": _rss_bytes() - memory}
+                print(f"Model {name} loaded in {load_time:.2f} s (warm-up {warmup_time:.2f} s, "
+                      f"{self._stats[name]['memory'] / 2 ** 20:.1f} MB)")
+            self.state = ModelRegistry.READY
+        except Exception as e:
+            self.state = ModelRegistry.FAILED
+            self.error = str(e)
+            print(f"Model loading failed: {e}")
+        self._ready.set()
+
+    def start(self):  # Loads the models in background, the server can accept connections in the meantime
+        threading.Thread(target=self.load_all, daemon=True).start()
+
+    def wait_ready(self, timeout=None):
+        self._ready.wait(timeout)
+        if self.state != ModelRegistry.READY:
+            raise RuntimeError("Models not available: " + str(self.error or self.state))
+
+    def get(self, name):  # Returns the model, waiting for the end of the loading if it is not loaded yet
+        if name not in self._models:
+            self.wait_ready()
+        return self._models[name]
+
+    def report(self):
+        return {"state": self.state, "models": dict(self._stats)}
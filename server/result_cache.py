@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def perceptual_hash(frame, hash_size=16):
+    """
+    Difference hash of the frame: the frame is reduced to a (hash_size, hash_size + 1) grayscale thumbnail
+    (mean of blocks of pixels) and every bit tells if a pixel is brighter than its right neighbour. Frames that
+    differ only for noise or compression artifacts have the same hash
+    """
+    block_height, block_width = frame.shape[0] // hash_size, frame.shape[1] // (hash_size + 1)
+    blocks = frame[:block_height * hash_size, :block_width * (hash_size + 1)]
+    blocks = blocks.reshape(hash_size, block_height, hash_size + 1, block_width, -1)
+    thumbnail = blocks.mean(axis=(1, 3, 4), dtype=np.float32)
+    return np.packbits(thumbnail[:, 1:] > thumbnail[:, :-1]).tobytes()
+
+
+class ResultCache:
+    """
+    LRU cache of the results of the analyses, keyed by kind of analysis and perceptual hash of the frame, so
+    that equal frames sent by different requests (or clients) within a short time are analyzed once.
+    Every kind has its own time to live (e.g. the identity of the user changes much more slowly than its
+    emotion); kinds without a ttl are not cached. At most max_entries results are kept
+    """
+
+    def __init__(self, ttls, max_entries=1024):
+        self._ttls = ttls  # kind -> seconds
+        self._max_entries = max_entries
+        self._entries = OrderedDict()  # (kind, hash) -> (expiration time, result), in order of use
+        self._lock = threading.Lock()
+        self._stats = {kind: {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0} for kind in ttls}
+
+    def get_or_compute(self, kind, frame_hash, compute):
+        """
+        Returns the result of the analysis kind for the frame, calling compute() only if it is not in the cache
+        """
+        if kind not in self._ttls:
+            return compute()
+        key = (kind, frame_hash)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._stats[kind]["hits"] += 1
+                    return entry[1]
+                del self._entries[key]
+                self._stats[kind]["expirations"] += 1
+            self._stats[kind]["misses"] += 1
+        # the analysis is done without holding the lock (the same frame can be rarely analyzed twice)
+        result = compute()
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttls[kind], result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                (evicted_kind, _), _ = self._entries.popitem(last=False)
+                self._stats[evicted_kind]["evictions"] += 1
+        return result
+
+    def invalidate(self, kind):  # Removes the results of a kind (e.g. the identities after a sign-up)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == kind]:
+                del self._entries[key]
+
+    def report(self):
+        with self._lock:
+            report = {kind: dict(stats) for kind, stats in self._stats.items()}
+            report["entries"] = len(self._entries)
+        return report
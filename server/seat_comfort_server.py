@@ -1,123 +1,429 @@
-import pickle
-import socket
+import argparse
+import functools
 import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from PIL import Image
 from deepface import DeepFace
 
+import frame_codec
+import metrics
 import socket_communication
+from server.eyes_batcher import EyesBatchScheduler
 from server.eyesdetection.eyes_detection import EyesDetection
+from server.face_index import FaceIndex
+from server.face_preprocessor import FacePreprocessor, preprocess_frame
+from server.model_registry import ModelRegistry
+from server.result_cache import ResultCache, perceptual_hash
 from server.users_storage_controller import UsersStorageController
 from user import User
 
 
+class RecognitionCascade:
+    """
+    First stage of the recognition of the users of a seat: the last user recognized with the face model, with the
+    descriptor of its face (see PreprocessedFrame.face_descriptor). A face whose descriptor is within max_distance
+    from it is the same user, without running the model (early exit); after max_early_exits early exits in a row
+    the face is verified again with the model
+    """
+
+    def __init__(self, max_distance=0.05, max_early_exits=30):
+        self.max_distance = max_distance
+        self.max_early_exits = max_early_exits
+        self._lock = threading.Lock()  # the requests of a session are handled by several workers
+        self._name = None
+        self._distance = None  # Distance of the match of the model
+        self._descriptor = None
+        self._consecutive_early_exits = 0
+        self.early_exits = 0
+        self.model_recognitions = 0
+
+    def verify(self, descriptor):
+        """
+        Returns the last user and the distance of its match with the model if the face is the same, (None, None)
+        if the model is needed
+        """
+        with self._lock:
+            if self._name is None or self._consecutive_early_exits >= self.max_early_exits \
+                    or 1 - float(self._descriptor @ descriptor) > self.max_distance:
+                return None, None
+            self._consecutive_early_exits += 1
+            self.early_exits += 1
+            return self._name, self._distance
+
+    def update(self, name, distance, descriptor):  # Result of the model for the face
+        with self._lock:
+            self.model_recognitions += 1
+            self._name = name
+            self._distance = distance
+            self._descriptor = descriptor
+            self._consecutive_early_exits = 0
+
+    def report(self):
+        recognitions = self.early_exits + self.model_recognitions
+        return {"early_exits": self.early_exits, "model_recognitions": self.model_recognitions,
+                "early_exit_ratio": self.early_exits / recognitions if recognitions > 0 else 0}
+
+
+class ClientSession:
+    """
+    State of the analysis of the frames of a client (seat), kept between its requests
+    """
+
+    def __init__(self, address, recognition=None):
+        self.address = address
+        # Face detection stage of the seat (face tracking and cache of the preprocessed frames)
+        self.face_preprocessor = FacePreprocessor()
+        # Last user recognized on the seat, verified before running the face model (shared by the sessions of
+        # the seat, see SeatComfortServer.seat_recognition)
+        self.recognition = recognition if recognition is not None else RecognitionCascade()
+
+    def report(self):
+        return dict(self.face_preprocessor.report(), recognition=self.recognition.report())
+
+
 class SeatComfortServer:
     AWAKE_POSITION_DEFAULT = 0  # Position of the back seat when the user is awake
     SLEEPING_POSITION_DEFAULT = 60  # Degrees w.r.t "awake position" of the back seat when the user is sleeping
+    FACE_MODEL = "VGG-Face"  # Model used for the embeddings of the faces
+    EMOTION_MODEL = "Emotion"  # Model used for the classification of the emotions
+    # Seconds a result is reused for frames with the same perceptual hash, per kind of analysis. Only the identity
+    # is cached: the hash does not see small local changes of the face, so a closure of the eyes or a change of
+    # expression would get the result of the previous frame (e.g. a blink confirmed by the next frames)
+    RESULT_TTLS = {"user": 60}
+    # Enrollment: embeddings stored at the sign-up, from the sharpest frames of the burst with a face
+    ENROLLMENT_EMBEDDINGS = 5
+    MIN_SHARPNESS = 30  # Minimum variance of the Laplacian of the face
+    # Recognitions closer than UPDATE_DISTANCE add the embedding to the user (within the budget of the index),
+    # unless it is closer than MIN_NOVELTY to an embedding already stored
+    UPDATE_DISTANCE = 0.25
+    MIN_NOVELTY = 0.08
 
-    def __init__(self):
-        self._user_faces_dir = "data/user_faces_db"
-        self._users_storage_controller = UsersStorageController()
-        self._host = '169.254.232.238'
-        self._port = 8000
-
-        self.eyes_detection = EyesDetection()
-
-    def detect_user(self, img):  # Returns the name of the user if it is registered, None otherwise
-        lst = os.listdir(self._user_faces_dir)
-        if len(lst) > 0:  # If there is at least one user registered
-            recognition = DeepFace.find(img, db_path=self._user_faces_dir, enforce_detection=False)
-            if recognition[0].empty:  # User not recognized
-                return None
-            else:  # User recognized
-                file_name = os.path.basename(recognition[0]["identity"][0])
+    def __init__(self, host='169.254.232.238', port=8000, max_workers=4, backlog=16, max_in_flight=8,
+                 data_dir="data", incremental_enrollment=True):
+        # data_dir: pictures, face index, profiles and metrics of the users (e.g. a copy for the benchmarks)
+        self._user_faces_dir = os.path.join(data_dir, "user_faces_db")
+        self._face_index = FaceIndex(os.path.join(data_dir, "face_index"))
+        self._metrics_path = os.path.join(data_dir, "metrics.jsonl")
+        self._users_storage_controller = UsersStorageController(os.path.join(data_dir, "users.db"),
+                                                                os.path.join(data_dir, "users"))
+        # the confident recognitions add new views of the face to the index of the user
+        self._incremental_enrollment = incremental_enrollment
+        self._host = host
+        self._port = port
+        self._backlog = backlog  # Maximum number of pending connections (seats)
+        # Worker pool for the inference, shared among the connections
+        self._inference_pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._max_in_flight = max_in_flight  # Maximum number of pipelined requests of a client
+        # Results of the analyses shared among the requests and the connections
+        self._results = ResultCache(SeatComfortServer.RESULT_TTLS)
+        # Recognition cascade of every seat (id sent by the client in the hello), kept across the reconnections
+        self._seat_recognitions = {}
+        self._seat_recognitions_lock = threading.Lock()
+        self._sign_up_lock = threading.Lock()  # the sign-ups are serialized, so a name is registered only once
+
+        # Models loaded and warmed up at startup. The eyes detection is loaded first, its face detector
+        # is shared by all the analyzers (see FacePreprocessor)
+        self._models = ModelRegistry()
+        # need-detection frames of all the connections are batched in a single inference
+        self._models.register("eyes", lambda: EyesBatchScheduler(EyesDetection()),
+                              lambda model, frame: model.warm_up(frame))
+        self._models.register("emotion", lambda: DeepFace.build_model(SeatComfortServer.EMOTION_MODEL),
+                              lambda model, frame: self.get_mood(frame, aligned=True))
+        self._models.register("face", lambda: DeepFace.build_model(SeatComfortServer.FACE_MODEL),
+                              self._warmup_face)
+
+    def _warmup_face(self, model, frame):
+        self.get_embedding(frame, aligned=True)
+        # Users registered before the introduction of the index: compute once the embeddings of their pictures
+        if len(self._face_index) == 0:
+            for file_name in sorted(os.listdir(self._user_faces_dir)):
                 name, extension = os.path.splitext(file_name)
-                user_name = name.split("/")[-1]
-                return user_name
-        else:
-            return None
+                if extension.lower() == ".jpg":
+                    img = np.array(Image.open(os.path.join(self._user_faces_dir, file_name)).convert("RGB"))
+                    self._face_index.add(name, self.get_frame_embedding(self.preprocess(img)))
+
+    def seat_recognition(self, seat):
+        """
+        Returns the RecognitionCascade of the seat: the last user of the seat is verified first also in a new
+        session (e.g. when the car is started again)
+        """
+        with self._seat_recognitions_lock:
+            if seat not in self._seat_recognitions:
+                self._seat_recognitions[seat] = RecognitionCascade()
+            return self._seat_recognitions[seat]
 
-    def get_mood(self, img):  # It returns 1 if the detected emotion was "bad", 0 otherwise
-        detection = DeepFace.analyze(img, actions=["emotion"], enforce_detection=False)
+    def preprocess(self, frame, session=None, frame_id=None):
+        """
+        Detects the faces of the frame once for all the analyzers. With a session, the face is tracked and the
+        result is cached by frame id
+        """
+        eyes_detection = self._models.get("eyes").eyes_detection
+        if session is None:
+            return preprocess_frame(frame, eyes_detection)
+        return session.face_preprocessor.process(frame, frame_id, eyes_detection)
+
+    def get_embedding(self, img, aligned=False):  # Returns the embedding of the face in the image
+        # aligned: the image is the crop of the face, the face detection of DeepFace is skipped
+        representation = DeepFace.represent(img, model_name=SeatComfortServer.FACE_MODEL, enforce_detection=False,
+                                            detector_backend="skip" if aligned else "opencv")
+        return representation[0]["embedding"]
+
+    def get_frame_embedding(self, preprocessed):
+        # Returns the embedding of the first face of the frame (detected by DeepFace if none was found)
+        face = preprocessed.aligned_face()
+        if face is None:
+            return self.get_embedding(preprocessed.frame)
+        return self.get_embedding(face, aligned=True)
+
+    def detect_user(self, preprocessed, session=None):
+        """
+        Returns the name of the user if it is registered (None otherwise) and the cosine distance of the match
+        (None if there are no faces). With a session the recognition is cascaded: the face is first compared with
+        the last user of the seat (see RecognitionCascade) and only if it differs the face model and the index
+        are used. For the early exits the distance is the one of the last match of the model
+        """
+        if len(self._face_index) == 0 or len(preprocessed.faces) == 0:  # No user registered or no faces
+            return None, None
+        descriptor = preprocessed.face_descriptor()
+        if session is not None:
+            name, distance = session.recognition.verify(descriptor)
+            if name is not None:
+                return name, distance
+        embedding = self.get_embedding(preprocessed.aligned_face(), aligned=True)
+        name, distance = self._face_index.search(embedding)
+        if self._incremental_enrollment and name is not None \
+                and SeatComfortServer.MIN_NOVELTY <= distance <= SeatComfortServer.UPDATE_DISTANCE:
+            # confident match with a new view of the face: it helps to recognize the user next time
+            self._face_index.add(name, embedding)
+        if session is not None:
+            session.recognition.update(name, distance, descriptor)
+        return name, distance
+
+    def enroll(self, name, pictures):
+        """
+        Adds to the face index the embeddings of the sharpest pictures of the burst where a face is found,
+        skipping the ones almost equal to an embedding already chosen. Returns the number of embeddings added
+        """
+        candidates = []
+        for picture in pictures:
+            preprocessed = self.preprocess(picture)
+            sharpness = preprocessed.sharpness()
+            if sharpness is not None and sharpness >= SeatComfortServer.MIN_SHARPNESS:
+                candidates.append((sharpness, preprocessed))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        embeddings = []
+        for _, preprocessed in candidates:
+            embedding = np.asarray(self.get_embedding(preprocessed.aligned_face(), aligned=True), dtype=np.float32)
+            embedding /= np.linalg.norm(embedding)
+            if all(1 - chosen @ embedding >= SeatComfortServer.MIN_NOVELTY for chosen in embeddings):
+                embeddings.append(embedding)
+                if len(embeddings) == 1:  # the sharpest picture is also saved in the faces db
+                    Image.fromarray(preprocessed.frame).save(self._user_faces_dir + "/" + name + ".jpg")
+                if len(embeddings) == SeatComfortServer.ENROLLMENT_EMBEDDINGS:
+                    break
+        return sum(self._face_index.add(name, embedding) for embedding in embeddings)
+
+    def get_mood(self, img, aligned=False):  # Returns the dominant emotion
+        # aligned: the image is the crop of the face, the face detection of DeepFace is skipped
+        detection = DeepFace.analyze(img, actions=["emotion"], enforce_detection=False,
+                                     detector_backend="skip" if aligned else "opencv")
         emotion = detection[0]['dominant_emotion']
         return emotion
 
+    def get_frame_mood(self, preprocessed):
+        # Returns the dominant emotion of the first face of the frame (detected by DeepFace if none was found)
+        face = preprocessed.aligned_face()
+        if face is None:
+            return self.get_mood(preprocessed.frame)
+        return self.get_mood(face, aligned=True)
+
+    def _cached_results(self, data, session):
+        """
+        Returns a function giving the result of an analysis ("user", "emotion" or "eyes") of the frame of the
+        request, from the cache if an equal frame was analyzed recently. The frame is preprocessed only once
+        and only if some analysis is not in the cache
+        """
+        frame_hash = perceptual_hash(data['frame'])
+        preprocess = functools.lru_cache(maxsize=None)(
+            functools.partial(self.preprocess, data['frame'], session, data.get('frame_id')))
+        analyses = {"user": lambda: self.detect_user(preprocess(), session),
+                    "emotion": lambda: self.get_frame_mood(preprocess()),
+                    "eyes": lambda: self._models.get("eyes").classify_face_crops(preprocess().face_crops())}
+        return lambda kind: self._results.get_or_compute(kind, frame_hash, analyses[kind])
+
+    def handle_message(self, data, session):
+        """
+        Handles a request of the client (with the state of its session) and returns the reply together with
+        the phase used for the timing logs
+        """
+        if data['type'] not in ('save', 'position-delta'):  # the requests that need the models wait for them
+            self._models.wait_ready()
+        if data['type'] == 'sign-up':
+            # recv the name and a burst of pictures (or a single picture)
+            name = data['name']
+            pictures = data['picture'] if data['picture'].ndim == 4 else data['picture'][np.newaxis]
+            with self._sign_up_lock:
+                # the name of a registered user is never reused: its faces and positions are kept
+                if self._face_index.count(name) > 0 or len(self._users_storage_controller.retrieve_users([name])) > 0:
+                    return {'payload': -2}, ""
+                # add the user to the face index (incremental update)
+                embeddings = self.enroll(name, pictures)
+                if embeddings == 0:  # no sharp face in the pictures
+                    return {'payload': -1}, ""
+                self._results.invalidate("user")  # the frames without known users may contain the new one
+                new_user = User(name,
+                                SeatComfortServer.AWAKE_POSITION_DEFAULT,
+                                SeatComfortServer.SLEEPING_POSITION_DEFAULT)
+                self._users_storage_controller.save_user(new_user)
+            # create the reply with the number of embeddings of the user
+            return {'payload': embeddings}, ""
+        elif data['type'] == 'user-recognition':
+            # recv the frame from the client
+            name, distance = self._cached_results(data, session)("user")
+            # reply with the detetcted user and the distance of the match
+            if name is None:
+                reply_msg = {'payload': None, 'distance': distance}
+            else:
+                user = self._users_storage_controller.retrieve_user(name)
+                reply_msg = {'payload': user, 'distance': distance}
+            return reply_msg, "U"
+        elif data['type'] == 'need-detection':
+            # recv the frame from the client and classify the eyes state
+            eyes_state = self._cached_results(data, session)("eyes")
+            return {'payload': eyes_state}, "N"
+        elif data['type'] == 'mood-detection':
+            # recv the frame from the client and classify the emotion
+            emotion = self._cached_results(data, session)("emotion")
+            # reply with the detetcted emotion
+            return {'payload': emotion}, "M"
+        elif data['type'] == 'analyze':
+            # eyes state, emotion and user of the frame with a single face detection
+            results = self._cached_results(data, session)
+            eyes_state = results("eyes")
+            emotion = results("emotion")
+            name, distance = results("user")
+            user = None if name is None else self._users_storage_controller.retrieve_user(name)
+            return {'eyes': eyes_state, 'emotion': emotion, 'user': user, 'distance': distance}, "A"
+        elif data['type'] == 'save':
+            # recv the user to be saved
+            self._users_storage_controller.save_user(data['user'])
+            return {'payload': 'OK'}, ""
+        elif data['type'] == 'position-delta':
+            # adjustments of the positions made by the user since the last batch
+            self._users_storage_controller.apply_position_deltas(data['name'], data['awake'], data['sleep'])
+            return {'payload': 0}, ""
+        raise socket_communication.ProtocolError("Unexpected message " + data['type'])
+
+    def _process(self, data, session):  # handle_message in the worker pool, recording the inference time
+        start_time = time.perf_counter()
+        reply_msg, phase = self.handle_message(data, session)
+        metrics.record("server", phase, "inference", time.perf_counter() - start_time)
+        return reply_msg, phase
+
+    def _reply(self, connection, data, in_flight, future):
+        # send the reply of a request as soon as its inference is completed, with the id of the request
+        try:
+            reply_msg, phase = future.result()
+            reply_msg[socket_communication.REQUEST_ID_FIELD] = data[socket_communication.REQUEST_ID_FIELD]
+            connection.send(reply_msg, phase)
+        except OSError:
+            pass  # the client has already disconnected
+        except Exception as e:
+            print(f"Error handling {data['type']}: {e!r}")
+            # error reply, so the request of the client does not wait forever
+            try:
+                connection.send({socket_communication.ERROR_FIELD: repr(e),
+                                 socket_communication.REQUEST_ID_FIELD: data[socket_communication.REQUEST_ID_FIELD]})
+            except OSError:
+                pass
+        finally:
+            in_flight.release()
+
+    def serve_client(self, client_socket, client_address):
+        """
+        Thread that serves a single client (seat). The connection keeps its own socket, timings and frame
+        decoder, while the inference is done by the worker pool shared among all the clients.
+        Requests are pipelined: they are submitted to the pool as soon as they are received and each reply
+        is sent when ready, so replies can be out of order (the client matches them by request id)
+        """
+        connection = socket_communication.Connection(client_socket)
+        in_flight = threading.BoundedSemaphore(self._max_in_flight)  # requests of this client in the pool
+        session = ClientSession(client_address)  # clients without a seat id have a cascade per connection
+        print(f"Connection from {client_address}")
+        try:
+            while True:
+                data = connection.recv()
+                if data['type'] in ('hello', 'status'):
+                    if data['type'] == 'hello':
+                        # choose the compression of the frames among the ones proposed by the client
+                        reply_msg = {'payload': frame_codec.choose_codec(data['codecs'])}
+                        if data.get('seat') is not None:  # the last user of the seat is verified first
+                            session.recognition = self.seat_recognition(data['seat'])
+                    else:
+                        # readiness of the models, with their load time and memory footprint, and the
+                        # statistics of the session (e.g. face tracking hit rates) and of the result cache
+                        reply_msg = {'payload': dict(self._models.report(), result_cache=self._results.report(),
+                                                     **session.report())}
+                    reply_msg[socket_communication.REQUEST_ID_FIELD] = data[socket_communication.REQUEST_ID_FIELD]
+                    connection.send(reply_msg)
+                    continue
+                in_flight.acquire()
+                future = self._inference_pool.submit(self._process, data, session)
+                if data['type'] == 'save':
+                    # the profile must be saved before closing the connection
+                    self._reply(connection, data, in_flight, future)
+                    print(f"Client {client_address} disconnected")
+                    break
+                future.add_done_callback(functools.partial(self._reply, connection, data, in_flight))
+        except (ConnectionResetError, BrokenPipeError):
+            print(f"Client {client_address} disconnected")
+        except socket_communication.ProtocolError as e:  # also the messages that cannot be decoded
+            print(f"Client {client_address} protocol error: {e}")
+        except Exception as e:
+            print(f"Client {client_address} error: {e!r}")
+        finally:
+            # the client sees the connection closed and fails its pending requests
+            connection.close()
+        print(f"Client {client_address} session: {session.report()}")
+
     def run(self):
         # create the socket
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind((self._host, self._port))
-        server_socket.listen(1)
+        server_socket.listen(self._backlog)
+        # load the models in background, the requests that need them wait for the end of the loading
+        self._models.start()
+        # latencies of the stages and bytes of the frames, exported periodically
+        metrics.registry.start(path=self._metrics_path)
 
         print(f"Server listening on {self._host}:{self._port}")
 
         try:
             while True:
-                # Accept a connection from a client
-                socket_communication.sock, client_address = server_socket.accept()
-                print(f"Connection from {client_address}")
-
-                try:
-                    while True:
-                        data = socket_communication.recv()
-                        if data['type'] == 'sign-up':
-                            # save the recv name and image
-                            name = data['name']
-                            picture = np.frombuffer(data['picture'], dtype=np.uint8).reshape((540, 432, 3))
-                            img_pil = Image.fromarray(picture)
-                            img_pil.save(self._user_faces_dir + "/" + name + ".jpg")
-                            new_user = User(name,
-                                            SeatComfortServer.AWAKE_POSITION_DEFAULT,
-                                            SeatComfortServer.SLEEPING_POSITION_DEFAULT)
-                            self._users_storage_controller.save_user(new_user)
-
-                            # create the reply
-                            reply_msg = {'payload': 0}
-                            socket_communication.send(reply_msg)
-                            pass
-                        elif data['type'] == 'user-recognition':
-                            # recv the frame from the client
-                            frame = np.frombuffer(data['frame'], dtype=np.uint8).reshape((540, 432, 3))
-                            name = self.detect_user(frame)
-                            # reply with the name of the detetcted user
-                            if name is None:
-                                reply_msg = {'payload': None}
-                            else:
-                                user = self._users_storage_controller.retrieve_user(name)
-                                reply_msg = {'payload': pickle.dumps(user)}
-                            socket_communication.send(reply_msg, "U")
-                        elif data['type'] == 'need-detection':
-                            # recv the frame from the client and classify the eyes state
-                            frame = np.frombuffer(data['frame'], dtype=np.uint8).reshape((540, 432, 3))
-                            eyes_state = self.eyes_detection.classify_eyes(frame)
-                            reply_msg = {'payload': eyes_state}
-                            socket_communication.send(reply_msg, "N")
-                        elif data['type'] == 'mood-detection':
-                            # recv the frame from the client and classify the emotion
-                            frame = np.frombuffer(data['frame'], dtype=np.uint8).reshape((540, 432, 3))
-                            emotion = self.get_mood(frame)
-                            # reply with the detetcted emotion
-                            reply_msg = {'payload': emotion}
-                            socket_communication.send(reply_msg, "M")
-                        elif data['type'] == 'save':
-                            # recv the user to be saved
-                            user = pickle.loads(data['user'])
-                            self._users_storage_controller.save_user(user)
-                            reply_msg = {'payload': 'OK'}
-                            socket_communication.send(reply_msg)
-                            print("Client disconnected")
-                            socket_communication.sock.close()
-                            break
-
-                except (ConnectionResetError, BrokenPipeError):
-                    print("Client disconnected")
-                    socket_communication.sock.close()
+                # Accept a connection from a client and serve it in its own thread
+                client_socket, client_address = server_socket.accept()
+                client_thread = threading.Thread(target=self.serve_client, args=(client_socket, client_address),
+                                                 daemon=True)
+                client_thread.start()
 
         except KeyboardInterrupt:
-            print("Client interrupted by keyboard. Closing connection.")
-            socket_communication.sock.close()
+            print("Server interrupted by keyboard. Closing connections.")
             server_socket.close()
+            self._inference_pool.shutdown(wait=False)
+            metrics.registry.stop(path=self._metrics_path)
+            print(metrics.report())
 
 
 if __name__ == '__main__':
-    SeatComfortServer().run()
+    parser = argparse.ArgumentParser(description="Seat comfort server")
+    parser.add_argument("--host", default='169.254.232.238')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=4, help="size of the inference worker pool")
+    args = parser.parse_args()
+    SeatComfortServer(args.host, args.port, args.workers).run()
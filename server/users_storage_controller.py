@@ -1,13 +1,113 @@
-import joblib
+import copy
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from user import decode_user, encode_user
 
 
 class UsersStorageController:
-    def __init__(self):
-        self._users_path = "data/users/"
+    """
+    Profiles of the registered users, stored in a single SQLite database indexed by name (every profile is the
+    binary record of the User, the same sent on the wire). The profiles read or saved are kept in an in-memory
+    LRU cache, so the recognition of a user does not touch the disk (the callers get copies, the cache always
+    matches the database). Every save is an atomic transaction, appended and synced to the write-ahead log of
+    the database before returning (the adjustments of the positions are small incremental updates of the
+    profile, see apply_position_deltas), so a power loss never loses a profile already saved. The profiles of
+    the previous storage (one joblib file per user in legacy_path) are imported the first time the database is
+    created
+    """
+
+    def __init__(self, db_path="data/users.db", legacy_path="data/users/", cache_size=4096):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS profiles (name TEXT PRIMARY KEY, profile BLOB)")
+        self._lock = threading.Lock()  # the connection is shared by the worker threads
+        self._cache = OrderedDict()  # name -> User, in order of use
+        self._cache_size = cache_size
+        if self.count() == 0 and legacy_path is not None and os.path.isdir(legacy_path):
+            self._import_legacy(legacy_path)
+
+    def _import_legacy(self, legacy_path):
+        import joblib
+
+        users = [joblib.load(os.path.join(legacy_path, name)) for name in sorted(os.listdir(legacy_path))
+                 if os.path.isfile(os.path.join(legacy_path, name))]
+        self.save_users(users)
+
+    def _cache_put(self, user):
+        self._cache[user.get_name()] = user
+        self._cache.move_to_end(user.get_name())
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
 
-    def retrieve_user(self, name):  # It retrieves from a file the registered user and associated data
-        return joblib.load(self._users_path + name)
+    def count(self):  # Number of registered users
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM profiles").fetchone()[0]
+
+    def retrieve_user(self, name):  # It retrieves the registered user and associated data
+        user = self.retrieve_users([name]).get(name)
+        if user is None:
+            raise KeyError("User " + name + " not registered")
+        return user
+
+    def retrieve_users(self, names):
+        """
+        Returns a dict name -> User with copies of the registered users among names, reading from the database
+        only the ones not in the cache (with a single query)
+        """
+        with self._lock:
+            return {name: copy.copy(user) for name, user in self._lookup(names).items()}
+
+    def _lookup(self, names):  # The cached users among names, loading the missing ones (with the lock held)
+        users = {}
+        missing = []
+        for name in names:
+            if name in self._cache:
+                self._cache.move_to_end(name)
+                users[name] = self._cache[name]
+            else:
+                missing.append(name)
+        for start in range(0, len(missing), 500):  # limit of the parameters of a query
+            chunk = missing[start:start + 500]
+            rows = self._db.execute("SELECT profile FROM profiles WHERE name IN (" + ",".join("?" * len(chunk))
+                                    + ")", chunk)
+            for profile, in rows:
+                user = decode_user(profile)
+                self._cache_put(user)
+                users[user.get_name()] = user
+        return users
 
     def save_user(self, user):  # It saves the user
-        joblib.dump(user, self._users_path + user.get_name())
+        self.save_users([user])
+
+    def save_users(self, users):  # It saves the users in a single transaction
+        with self._lock:
+            with self._db:  # commit, or rollback if a write fails
+                self._db.executemany("INSERT OR REPLACE INTO profiles VALUES (?, ?)",
+                                     [(user.get_name(), encode_user(user)) for user in users])
+            for user in users:  # the caller can still change its users
+                self._cache_put(copy.copy(user))
+
+    def apply_position_deltas(self, name, awake_delta, sleep_delta):
+        """
+        Adds the deltas to the awake and sleep positions of the user in a single transaction. Returns the
+        updated user
+        """
+        with self._lock:
+            cached = self._lookup([name]).get(name)
+            if cached is None:
+                raise KeyError("User " + name + " not registered")
+            # the update is done on a copy, the cache is changed only if the transaction commits
+            user = copy.copy(cached)
+            user.update_positions_by_delta(awake_delta, sleep_delta)
+            with self._db:
+                self._db.execute("UPDATE profiles SET profile = ? WHERE name = ?", (encode_user(user), name))
+            self._cache_put(user)
+        return copy.copy(user)
 
+    def close(self):
+        with self._lock:
+            self._db.close()
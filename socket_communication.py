@@ -1,47 +1,354 @@
-import ast
+import itertools
+import json
+import socket
+import struct
+import threading
 import time
+from concurrent.futures import Future
 
-sock = None
+import numpy as np
 
-executor = None
-start_time = 0
+import frame_codec
+import metrics
+from user import User, decode_user, encode_user
 
+# Connection used by the module level send/recv (the client has a single connection to the server)
+connection = None
+
+# Binary wire format (little endian). Every message is made of:
+#   - a fixed size header: magic, protocol version, message type, codec of the frame, dtype of the buffer,
+#     number of dimensions, shape (up to 4 dimensions), request id, length of the metadata and length of the buffer.
+#     The request id is chosen by the client and copied by the server in the reply (0: no id)
+#   - the metadata: a utf-8 JSON object with all the fields of the message that are not the buffer
+#   - the buffer: the raw bytes of the (only) numpy array, bytes or User field of the message. When the codec is
+#     not 'raw' the buffer is the compressed frame, while dtype and shape are the ones of the decoded frame.
+#     A User is sent with its binary record (see user.encode_user), never pickled
+PROTOCOL_MAGIC = b'SC'
+PROTOCOL_VERSION = 4
+_HEADER = struct.Struct('<2sBBBBB4IIIQ')
+HEADER_SIZE = _HEADER.size
+MAX_DIMS = 4
+# Largest metadata and buffer (also once decoded) accepted from the peer, checked before allocating them.
+# The largest message is the burst of frames of the sign up
+MAX_META_SIZE = 2 ** 20
+MAX_BUFFER_SIZE = 2 ** 26
+
+# Message types carried in the header, 'reply' is used for messages without a 'type' field
+MESSAGE_TYPES = ['reply', 'sign-up', 'user-recognition', 'need-detection', 'mood-detection', 'save', 'hello',
+                 'status', 'analyze', 'position-delta']
+_MESSAGE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES)}
+
+# dtype of the buffer, None means that the buffer is a plain bytes object and 'user' a User record
+DTYPES = [None, 'uint8', 'int8', 'uint16', 'int16', 'int32', 'float32', 'float64', 'user']
+_DTYPE_CODES = {name: code for code, name in enumerate(DTYPES)}
+
+# Field of the metadata that stores the name of the field carrying the buffer
+_BUFFER_FIELD = '_buffer'
+# Field compressed with the negotiated codec and (optional) field with the JPEG produced by the camera for it
+FRAME_FIELD = 'frame'
+FRAME_JPEG_FIELD = 'jpeg'
+# Phase (for the timing logs) of the messages carrying frames
+PHASES = {'user-recognition': 'U', 'need-detection': 'N', 'mood-detection': 'M', 'analyze': 'A'}
+# Field of the message (not sent in the metadata) with the request id of the header
+REQUEST_ID_FIELD = 'request_id'
+# Field of the replies with the seconds the request spent in the server, to separate the network time
+SERVER_TIME_FIELD = 'server_time'
+# Field of the replies to the requests that the server failed to handle, with the description of the error
+ERROR_FIELD = 'error'
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ServerError(Exception):  # The server failed to handle the request (error reply)
+    pass
+
+
+class Connection:
+    """
+    A connection between the client and the server. It keeps the socket together with all the per-connection
+    state: the timing of the in-flight requests (recorded in the metrics), the frame encoder (client side)
+    and decoder (server side).
+    On the client side, once the dispatcher is started, several requests can be in flight at the same time:
+    each one gets an id and a future, completed by the dispatcher thread when the reply with that id arrives
+    """
+
+    def __init__(self, sock, executor="server"):
+        self.sock = sock
+        self.executor = executor
+        self.frame_encoder = frame_codec.FrameEncoder()
+        self.frame_decoder = frame_codec.FrameDecoder()
+        self._header_buffer = bytearray(HEADER_SIZE)
+        self._send_lock = threading.Lock()
+        self._start_times = {}  # request id -> time of the send (client) or receive (server) of the request
+        self._request_ids = itertools.count()
+        self._pending = {}  # request id -> (future, phase) of the requests waiting for the reply
+        self._pending_lock = threading.Lock()
+        self._dispatcher = None
+        self._closed = False
+
+    # In the following methods the 'phase' argument is used for the metrics and can assume U (User Recognition),
+    # N (Need Detection), M (Mood Detection), A (Analyze: U, N and M together)
+
+    def _record_reply(self, data, phase):
+        # client side: round trip of the request and, if the server sent its time, network time
+        start_time = self._start_times.pop(data[REQUEST_ID_FIELD], None)
+        if start_time is None:
+            return
+        round_trip = time.perf_counter() - start_time
+        metrics.record("client", phase, "round-trip", round_trip)
+        server_time = data.pop(SERVER_TIME_FIELD, None)
+        if server_time is not None:
+            metrics.record("client", phase, "network", round_trip - server_time)
+
+    def send(self, data, phase=""):
+        request_id = data.get(REQUEST_ID_FIELD, 0)
+        with self._send_lock:
+            if self.executor == "client":
+                self._start_times[request_id] = time.perf_counter()
+            else:
+                start_time = self._start_times.pop(request_id, None)
+                if start_time is not None:
+                    server_time = time.perf_counter() - start_time
+                    metrics.record("server", phase, "service", server_time)
+                    data = dict(data)
+                    data[SERVER_TIME_FIELD] = server_time
+            send_message(self.sock, data, self.frame_encoder, phase)
+
+    def recv(self, phase=""):
+        data = recv_message(self.sock, self._header_buffer, self.frame_decoder, phase)
+        if self.executor == "client":
+            self._record_reply(data, phase)
+        else:
+            self._start_times[data[REQUEST_ID_FIELD]] = time.perf_counter()
+        return data
+
+    def negotiate_codec(self, preferred, seat=None, **options):
+        """
+        Client side: proposes to the server the codecs in order of preference and sets the frame encoder
+        with the one chosen by the server. The seat (a string) identifies the seat of the client across
+        reconnections
+        """
+        hello = {"type": "hello", "codecs": preferred}
+        if seat is not None:
+            hello["seat"] = seat
+        self.send(hello)
+        codec = self.recv()["payload"]
+        self.frame_encoder = frame_codec.FrameEncoder(codec, **options)
+        return codec
+
+    def start_dispatcher(self):
+        """
+        Client side: starts the thread that receives the replies and dispatches them to the futures of
+        the requests. After this call the replies must be waited through the futures returned by request
+        """
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def request(self, data, phase=""):
+        """
+        Client side: sends the request without waiting for the reply and returns a future completed with it
+        """
+        future = Future()
+        request_id = next(self._request_ids) % (2 ** 32 - 1) + 1  # ids on 32 bits, 0 is reserved
+        with self._pending_lock:
+            if self._closed:
+                raise BrokenPipeError  # Connection closed
+            self._pending[request_id] = (future, phase)
+        try:
+            message = dict(data)
+            message[REQUEST_ID_FIELD] = request_id
+            self.send(message, phase)
+        except OSError:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise
+        return future
+
+    def _dispatch(self):
+        future = None  # Future of the reply being dispatched
+        try:
+            while True:
+                data = recv_message(self.sock, self._header_buffer, self.frame_decoder)
+                with self._pending_lock:
+                    future, phase = self._pending.pop(data[REQUEST_ID_FIELD], (None, ""))
+                self._record_reply(data, phase)
+                if future is None:
+                    continue
+                if ERROR_FIELD in data:
+                    future.set_exception(ServerError(data[ERROR_FIELD]))
+                else:
+                    future.set_result(data)
+                future = None
+        except Exception as e:
+            # connection closed, broken or with an unexpected error: fail all the requests still waiting for
+            # the reply, the new requests fail immediately
+            with self._pending_lock:
+                self._closed = True
+                pending = list(self._pending.values())
+                self._pending = {}
+            if future is not None and not future.done():
+                pending.append((future, ""))
+            for future, _ in pending:
+                future.set_exception(BrokenPipeError() if isinstance(e, OSError) else e)
+
+    def close(self):
+        with self._pending_lock:
+            self._closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
 
-# In the following functions the 'phase' argument is used for testing purposes (logging timestamps) and
-# can assume U (User Recognition), N (Need Detection), M (Mood Detection)
 
 def send(data, phase=""):
-    global start_time
-    if executor == "client":
-        start_time = time.time()
-    else:
-        with open("data/log.csv", "a") as f:
-            f.write(str(time.time() - start_time).replace('.', ',') + ' ' + phase + "\n")
-    # send the length in bytes of the message
-    data = str(data).encode(encoding='utf-8')
-    size_data = (len(data)).to_bytes(4, byteorder='little')
-    sock.sendall(size_data)
-    # send the message
-    sock.sendall(data)
+    connection.send(data, phase)
 
 
 def recv(phase=""):
-    global start_time
-    # recv data len
-    data_size = sock.recv(4)
-    if not data_size:
-        raise BrokenPipeError  # Connection closed
-    data_size = int.from_bytes(data_size, byteorder='little')
-    # recv the data
-    msg_data = b''
-    while len(msg_data) < data_size:
-        data = sock.recv(data_size - len(msg_data))
-        if not data:
+    return connection.recv(phase)
+
+
+def request(data, phase=""):
+    return connection.request(data, phase)
+
+
+def encode_message(data, encoder=None, phase=""):
+    """
+    Splits the message (a dict) in its header, metadata and buffer. The buffer is returned as a memoryview
+    on the original array, so that it can be sent without copying it. If an encoder is given, the frame
+    field is compressed with it
+    """
+    meta = {}
+    buffer_field = None
+    buffer = b''
+    codec = 0
+    dtype_code = 0
+    shape = ()
+    for key, value in data.items():
+        if key in (FRAME_JPEG_FIELD, REQUEST_ID_FIELD):  # jpeg is only used as source for the frame encoding
+            continue
+        if key == FRAME_FIELD and encoder is not None and isinstance(value, np.ndarray):
+            codec, value = encoder.encode(value, data.get(FRAME_JPEG_FIELD), phase)
+            if codec != 0:
+                if buffer_field is not None:
+                    raise ProtocolError("Only one buffer field per message is supported")
+                buffer_field = key
+                dtype_code = _DTYPE_CODES[data[key].dtype.name]
+                shape = data[key].shape
+                buffer = memoryview(value).cast('B')
+                continue
+        if isinstance(value, User):
+            if buffer_field is not None:
+                raise ProtocolError("Only one buffer field per message is supported")
+            buffer_field = key
+            dtype_code = _DTYPE_CODES['user']
+            buffer = memoryview(encode_user(value))
+        elif isinstance(value, (np.ndarray, bytes, bytearray, memoryview)):
+            if buffer_field is not None:
+                raise ProtocolError("Only one buffer field per message is supported")
+            buffer_field = key
+            if isinstance(value, np.ndarray):
+                if value.dtype.name not in _DTYPE_CODES or value.ndim > MAX_DIMS:
+                    raise ProtocolError("Unsupported array " + value.dtype.name + " " + str(value.shape))
+                value = np.ascontiguousarray(value)
+                dtype_code = _DTYPE_CODES[value.dtype.name]
+                shape = value.shape
+                buffer = memoryview(value).cast('B')
+            else:
+                buffer = memoryview(value).cast('B')
+        elif key != 'type':
+            meta[key] = value
+    if buffer_field is not None:
+        meta[_BUFFER_FIELD] = buffer_field
+    msg_type = data.get('type', 'reply')
+    if msg_type not in _MESSAGE_CODES:
+        raise ProtocolError("Unknown message type " + str(msg_type))
+    meta = json.dumps(meta).encode(encoding='utf-8')
+    padded_shape = tuple(shape) + (0,) * (MAX_DIMS - len(shape))
+    header = _HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, _MESSAGE_CODES[msg_type], codec, dtype_code,
+                          len(shape), *padded_shape, data.get(REQUEST_ID_FIELD, 0), len(meta), len(buffer))
+    return header, meta, buffer
+
+
+def decode_message(header, meta, buffer, decoder=None, phase=""):
+    """
+    Builds back the message (a dict) from its header, metadata and buffer. Arrays are built on top of the
+    buffer without copying it, compressed frames are decoded with the decoder. A message that cannot be
+    decoded (e.g. corrupted metadata or frame) raises ProtocolError
+    """
+    try:
+        return _decode_message(header, meta, buffer, decoder, phase)
+    except ProtocolError:
+        raise
+    except Exception as e:  # json, utf-8, zlib, PIL, numpy or User record errors
+        raise ProtocolError("Malformed message: " + repr(e)) from e
+
+
+def _decode_message(header, meta, buffer, decoder, phase):
+    magic, version, type_code, codec, dtype_code, ndim, *shape, request_id, _, _ = _HEADER.unpack(header)
+    shape = shape[:ndim]
+    data = json.loads(bytes(meta).decode('utf-8')) if len(meta) > 0 else {}
+    if not isinstance(data, dict):
+        raise ProtocolError("Malformed metadata")
+    if MESSAGE_TYPES[type_code] != 'reply':
+        data['type'] = MESSAGE_TYPES[type_code]
+    data[REQUEST_ID_FIELD] = request_id
+    buffer_field = data.pop(_BUFFER_FIELD, None)
+    if buffer_field is not None:
+        if codec != 0:
+            if decoder is None:
+                raise ProtocolError("Compressed frame received without a decoder")
+            if int(np.prod(shape, dtype=np.int64)) * np.dtype(DTYPES[dtype_code] or 'uint8').itemsize \
+                    > MAX_BUFFER_SIZE:
+                raise ProtocolError("Frame too large")
+            data[buffer_field] = decoder.decode(codec, buffer, shape,
+                                                phase or PHASES.get(MESSAGE_TYPES[type_code], ""))
+        elif dtype_code == 0:
+            data[buffer_field] = bytes(buffer)
+        elif DTYPES[dtype_code] == 'user':
+            data[buffer_field] = decode_user(buffer)
+        else:
+            data[buffer_field] = np.frombuffer(buffer, dtype=DTYPES[dtype_code]).reshape(shape)
+    return data
+
+
+def send_message(conn, data, encoder=None, phase=""):
+    header, meta, buffer = encode_message(data, encoder, phase)
+    conn.sendall(header + meta)
+    if len(buffer) > 0:
+        conn.sendall(buffer)
+
+
+def recv_into(conn, view):
+    # fill the whole view, raising BrokenPipeError if the connection is closed before
+    received = 0
+    while received < len(view):
+        n = conn.recv_into(view[received:])
+        if n == 0:
             raise BrokenPipeError  # Connection closed
-        msg_data += data
-    if executor == "client":
-        with open("data/log.csv", "a") as f:
-            f.write(str(time.time() - start_time).replace('.', ',') + ' ' + phase + "\n")
-    else:
-        start_time = time.time()
-    return ast.literal_eval(msg_data.decode('utf-8'))
+        received += n
+
+
+def recv_message(conn, header_buffer=None, decoder=None, phase=""):
+    if header_buffer is None:
+        header_buffer = bytearray(HEADER_SIZE)
+    recv_into(conn, memoryview(header_buffer))
+    magic, version, type_code, codec, dtype_code, ndim, *_, meta_size, buffer_size = _HEADER.unpack(header_buffer)
+    if magic != PROTOCOL_MAGIC:
+        raise ProtocolError("Bad magic number")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError("Unsupported protocol version " + str(version))
+    if type_code >= len(MESSAGE_TYPES) or codec >= len(frame_codec.CODECS) or dtype_code >= len(DTYPES) \
+            or ndim > MAX_DIMS:
+        raise ProtocolError("Malformed header")
+    if meta_size > MAX_META_SIZE or buffer_size > MAX_BUFFER_SIZE:
+        raise ProtocolError("Message too large")
+    # the buffer is preallocated with the size declared in the header and filled in place
+    meta = bytearray(meta_size)
+    recv_into(conn, memoryview(meta))
+    buffer = bytearray(buffer_size)
+    recv_into(conn, memoryview(buffer))
+    return decode_message(header_buffer, meta, buffer, decoder, phase)
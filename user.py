@@ -1,4 +1,13 @@
+import struct
+
+# Binary layout of a user (little endian): mode, awake position, sleep position (degrees), length of the name,
+# followed by the name in utf-8
+_USER_HEADER = struct.Struct('<?hhH')
+
+
 class User:  # Model class
+    __slots__ = ('_name', '_awake_position', '_sleep_position', '_mode')
+
     def __init__(self, name, awake_position, sleep_position):
         self._name = name
         self._awake_position = awake_position
@@ -17,6 +26,16 @@ class User:  # Model class
         else:  # if the actual mode is True, set the sleep position updating it of the delta value
             self._sleep_position += delta
 
+    def update_positions_by_delta(self, awake_delta, sleep_delta):  # update both the positions (whatever the mode)
+        self._awake_position += awake_delta
+        self._sleep_position += sleep_delta
+
+    def get_awake_position(self):
+        return self._awake_position
+
+    def get_sleep_position(self):
+        return self._sleep_position
+
     def get_position(self):
         if not self._mode:
             return self._awake_position
@@ -30,4 +49,27 @@ class User:  # Model class
         self._mode = mode
 
     def get_name(self):
-        return self._name
\ No newline at end of file
+        return self._name
+
+    def __setstate__(self, state):
+        # pickles of the users saved before the introduction of __slots__ have the attributes in a dict
+        if isinstance(state, tuple):
+            state = state[1]
+        for attribute, value in state.items():
+            setattr(self, attribute, value)
+
+    def __repr__(self):
+        return f"User({self._name!r}, {self._awake_position}, {self._sleep_position}, mode={self._mode})"
+
+
+def encode_user(user):  # Returns the compact binary record of the user
+    name = user.get_name().encode('utf-8')
+    return _USER_HEADER.pack(user.get_mode(), user.get_awake_position(), user.get_sleep_position(), len(name)) + name
+
+
+def decode_user(data):  # Builds back the user from its binary record
+    mode, awake_position, sleep_position, name_length = _USER_HEADER.unpack_from(data)
+    name = bytes(data[_USER_HEADER.size:_USER_HEADER.size + name_length]).decode('utf-8')
+    user = User(name, awake_position, sleep_position)
+    user.set_mode(mode)
+    return user